@@ -7,6 +7,10 @@ import random
 from brain_of_the_doctor import encode_image, analyze_image_with_query, generate_prescription
 from voice_of_the_patient import record_audio, transcribe_with_groq
 from voice_of_the_doctor import text_to_speech_with_gtts
+from consultation_pipeline import StageGraph
+
+# Seconds any single consultation stage may take
+STAGE_TIMEOUT = 90
 
 # System prompts in multiple languages
 SYSTEM_PROMPTS = {
@@ -34,17 +38,24 @@ def process_inputs(audio, text, image, language, progress=gr.Progress()):
             encoded_image = encode_image(image)
             diagnosis = analyze_image_with_query(
                 query=SYSTEM_PROMPTS[language],
-                encoded_image=encoded_image
+                encoded_image=encoded_image,
+                reuse_similar=False  # fixed prompt: only reuse exact photos
             )
         else:
             diagnosis = f"Response to: {input_text}"
 
-        # Generate audio with unique filename
+        # Generate audio with unique filename and the prescription side by side
         audio_file = get_unique_filename('.wav')
-        text_to_speech_with_gtts(diagnosis, audio_file, language)
-        
-        # Generate prescription
-        prescription = generate_prescription(diagnosis, language)
+        graph = StageGraph()
+        graph.add("audio", lambda diagnosis: text_to_speech_with_gtts(diagnosis, audio_file, language),
+                  deps=["diagnosis"], timeout=STAGE_TIMEOUT)
+        graph.add("prescription", lambda diagnosis: generate_prescription(diagnosis, language),
+                  deps=["diagnosis"], timeout=STAGE_TIMEOUT)
+        results = graph.run(diagnosis=diagnosis)
+        for stage in ("audio", "prescription"):
+            if stage in graph.errors:
+                raise graph.errors[stage]
+        prescription = results["prescription"]
         prescription_file = get_unique_filename('.txt')
         with open(prescription_file, 'w', encoding='utf-8') as f:
             f.write(prescription)
@@ -6,10 +6,11 @@ if not os.path.exists("D:/gradio_temp"):
 
 import gradio as gr
 from gtts import gTTS
+from replay_backend import install as install_backend
+install_backend()  # record/replay gTTS when AI_DOCTOR_BACKEND is set
 import numpy as np
 from PIL import Image
 import base64
-import shutil
 import tempfile
 import logging
 import io
@@ -22,9 +23,15 @@ from brain_of_the_doctor import (
     encode_image, 
     analyze_image_with_query, 
     generate_prescription,
-    analyze_text_query
+    analyze_text_query,
+    get_diagnosis_and_prescription,
+    stream_text_query
 )
 from voice_of_the_patient import record_audio, transcribe_with_groq
+from consultation_pipeline import StageGraph
+
+# Seconds any single consultation stage may take
+STAGE_TIMEOUT = 90
 
 # Supported languages mapping with proper language codes
 LANGUAGE_CODES = {
@@ -34,28 +41,11 @@ LANGUAGE_CODES = {
 }
 
 def image_to_base64(image_path):
-    """Convert an image file to a base64 string, using a true temp file for short path safety."""
+    """Convert an image file to a base64 string, reading it in place without a temp copy."""
     try:
-        # Create a temporary directory with a short path
-        temp_dir = tempfile.mkdtemp(dir="D:/gradio_temp")
-        _, ext = os.path.splitext(image_path)
-        new_path = os.path.join(temp_dir, f"temp{ext}")
-        
-        # Copy the file to the new location
-        shutil.copy2(image_path, new_path)
-        
-        # Read and encode the file
-        with open(new_path, "rb") as img_file:
-            encoded = base64.b64encode(img_file.read()).decode("utf-8")
-        
-        # Clean up
-        try:
-            os.remove(new_path)
-            os.rmdir(temp_dir)
-        except Exception as e:
-            logger.warning(f"Cleanup error: {str(e)}")
-            
-        return encoded
+        # Python's open() handles long paths itself, so no short-path copy is needed
+        with open(image_path, "rb") as img_file:
+            return base64.b64encode(img_file.read()).decode("utf-8")
     except Exception as e:
         logger.error(f"Error in image_to_base64: {str(e)}")
         return None
@@ -82,6 +72,50 @@ def save_audio_to_temp_file(audio_bytes):
     temp_file.close()
     return temp_file.name
 
+def spoken_summary_file(diagnosis, response_language):
+    """Speak the first sentence of the diagnosis into a temp MP3 file"""
+    language_code = LANGUAGE_CODES.get(response_language, "en")
+    # Only use the first sentence for audio
+    short_diagnosis = diagnosis.split('.')[0] + '.' if '.' in diagnosis else diagnosis
+    audio_bytes = text_to_speech_bytes(short_diagnosis, language_code)
+    if audio_bytes:
+        return save_audio_to_temp_file(audio_bytes)
+    return None
+
+def finish_text_diagnosis(text_input, diagnosis, response_language):
+    """Add the prescription and spoken summary for a finished text diagnosis"""
+    # The prescription and the spoken summary only need the diagnosis, so run them side by side
+    graph = StageGraph()
+    graph.add("prescription", lambda diagnosis: generate_prescription(diagnosis, response_language),
+              deps=["diagnosis"], timeout=STAGE_TIMEOUT)
+    graph.add("audio", lambda diagnosis: spoken_summary_file(diagnosis, response_language),
+              deps=["diagnosis"], timeout=STAGE_TIMEOUT)
+    results = graph.run(diagnosis=diagnosis)
+    if "prescription" not in results:
+        raise graph.errors["prescription"]
+    return text_input, diagnosis, results.get("audio"), results["prescription"], None
+
+def process_inputs_streaming(text_input, audio_input, image_input, response_language):
+    """Stream a text-only diagnosis into the UI; other inputs go through process_inputs"""
+    if audio_input or not text_input:
+        yield process_inputs(text_input, audio_input, image_input, response_language)
+        return
+    try:
+        diagnosis = ""
+        for chunk in stream_text_query(text_input, response_language):
+            diagnosis += chunk
+            yield text_input, diagnosis, None, "", None
+        if not diagnosis:
+            error_msg = "Could not analyze text. Please try again."
+            logger.error(error_msg)
+            yield error_msg, error_msg, None, error_msg, None
+            return
+        yield finish_text_diagnosis(text_input, diagnosis, response_language)
+    except Exception as e:
+        logger.error(f"Error processing text: {str(e)}")
+        error_msg = f"Error processing text: {str(e)}"
+        yield text_input or error_msg, error_msg, None, error_msg, None
+
 def process_inputs(text_input, audio_input, image_input, response_language):
     """Process all inputs and return diagnosis results"""
     try:
@@ -120,14 +154,7 @@ def process_inputs(text_input, audio_input, image_input, response_language):
                     error_msg = "Could not analyze text. Please try again."
                     logger.error(error_msg)
                     return error_msg, error_msg, None, error_msg, None
-                prescription = generate_prescription(diagnosis, response_language)
-                # Only use the first sentence for audio
-                short_diagnosis = diagnosis.split('.')[0] + '.' if '.' in diagnosis else diagnosis
-                audio_bytes = text_to_speech_bytes(short_diagnosis, language_code)
-                audio_filepath = None
-                if audio_bytes:
-                    audio_filepath = save_audio_to_temp_file(audio_bytes)
-                return text_input, diagnosis, audio_filepath, prescription, None
+                return finish_text_diagnosis(text_input, diagnosis, response_language)
             except Exception as e:
                 logger.error(f"Error processing text: {str(e)}")
                 error_msg = f"Error processing text: {str(e)}"
@@ -141,18 +168,18 @@ def process_inputs(text_input, audio_input, image_input, response_language):
                     error_msg = "Could not process image. Please try again."
                     logger.error(error_msg)
                     return error_msg, error_msg, None, error_msg, None
-                diagnosis = analyze_image_with_query(text_input or "Analyze this skin condition", image_base64, response_language)
+                diagnosis, prescription, recommendations = get_diagnosis_and_prescription(
+                    symptoms=text_input or "Analyze this skin condition",
+                    language=response_language,
+                    encoded_image=image_base64
+                )
                 if not diagnosis:
                     error_msg = "Could not analyze image. Please try again."
                     logger.error(error_msg)
                     return error_msg, error_msg, None, error_msg, None
-                prescription = generate_prescription(diagnosis, response_language)
-                # Only use the first sentence for audio
-                short_diagnosis = diagnosis.split('.')[0] + '.' if '.' in diagnosis else diagnosis
-                audio_bytes = text_to_speech_bytes(short_diagnosis, language_code)
-                audio_filepath = None
-                if audio_bytes:
-                    audio_filepath = save_audio_to_temp_file(audio_bytes)
+                if recommendations:
+                    diagnosis = f"{diagnosis}\n\n{recommendations}"
+                audio_filepath = spoken_summary_file(diagnosis, response_language)
                 return text_input or "Image analysis", diagnosis, audio_filepath, prescription, None
             except Exception as e:
                 logger.error(f"Error processing image: {str(e)}")
@@ -249,7 +276,7 @@ with gr.Blocks(title="VAIDYA - Medical Diagnosis") as app:
 
     # Set up the submit button click event
     submit_btn.click(
-        fn=process_inputs,
+        fn=process_inputs_streaming,
         inputs=[text_input, audio_input, image_input, language],
         outputs=[input_text, diagnosis, audio_output, prescription]
     )
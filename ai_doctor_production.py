@@ -2,14 +2,18 @@
 import io
 import gradio as gr
 from gtts import gTTS
+from replay_backend import install as install_backend
+install_backend()  # record/replay gTTS when AI_DOCTOR_BACKEND is set
 import numpy as np
 from brain_of_the_doctor import encode_image, analyze_image_with_query, generate_prescription
 from voice_of_the_patient import record_audio, transcribe_with_groq
+from consultation_pipeline import StageGraph
 
 # Server configuration
 SERVER_NAME = "0.0.0.0"  # Listen on all interfaces
 SERVER_PORT = 7860
 SHARE = True  # Enable public sharing
+STAGE_TIMEOUT = 90  # Seconds any single consultation stage may take
 
 # Language support
 LANGUAGE_CODES = {
@@ -49,18 +53,25 @@ def process_inputs(audio, text, image, language, progress=gr.Progress()):
             encoded_image = encode_image(image)
             diagnosis = analyze_image_with_query(
                 query=SYSTEM_PROMPTS[language],
-                encoded_image=encoded_image
+                encoded_image=encoded_image,
+                reuse_similar=False  # fixed prompt: only reuse exact photos
             )
         else:
             diagnosis = f"Response to: {input_text}"
 
-        # Generate audio in memory
-        audio_bytes = text_to_speech_bytes(diagnosis, language)
+        # Generate audio in memory and the prescription side by side
+        graph = StageGraph()
+        graph.add("audio", lambda diagnosis: text_to_speech_bytes(diagnosis, language),
+                  deps=["diagnosis"], timeout=STAGE_TIMEOUT)
+        graph.add("prescription", lambda diagnosis: generate_prescription(diagnosis, language),
+                  deps=["diagnosis"], timeout=STAGE_TIMEOUT)
+        results = graph.run(diagnosis=diagnosis)
+        if "prescription" in graph.errors:
+            raise graph.errors["prescription"]
+        audio_bytes = results.get("audio")
         if not audio_bytes:
             raise ValueError("Failed to generate audio response")
-            
-        # Generate prescription
-        prescription = generate_prescription(diagnosis, language)
+        prescription = results["prescription"]
             
         return (input_text, diagnosis, (16000, np.frombuffer(audio_bytes, dtype=np.int16)), prescription, 
                 gr.DownloadButton(visible=True))
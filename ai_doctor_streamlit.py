@@ -6,11 +6,13 @@ import streamlit as st
 st.set_page_config(page_title="Vaidya Ai - Healthcare assistant", layout="wide")
 
 from brain_of_the_doctor import (
-    encode_image,
-    analyze_image_with_query,
+    encode_images,
+    analyze_images_with_query,
     generate_prescription,
-    analyze_text_query
+    health_check,
+    stream_text_query
 )
+from video_intake import encode_video_frames
 try:
     from voice_of_the_patient import transcribe_with_groq
 except ImportError as e:
@@ -21,34 +23,44 @@ except ImportError as e:
         return None
 
 from gtts import gTTS
+from replay_backend import install as install_backend
+from speech_chunks import ChunkedSpeech
+from phrase_bank import synthesize_with_phrases, warm_up as warm_up_phrases
+install_backend()  # record/replay gTTS when AI_DOCTOR_BACKEND is set
+warm_up_phrases()  # pre-render disclaimers and prescription headings when PHRASE_BANK_WARM_UP=1
 import base64
 import io
+import logging
+from functools import lru_cache
+from consultation_pipeline import StageGraph
 
-@st.cache_data
+# Seconds any single consultation stage may take
+STAGE_TIMEOUT = 90
+
+@lru_cache(maxsize=64)
 def generate_audio_from_text(text, lang):
-    """Generates audio from text using gTTS and caches the result."""
+    """Generates audio from text using gTTS and caches the result.
+
+    Runs on pipeline worker threads, so it must not call Streamlit.
+    """
     try:
-        tts = gTTS(text=text, lang=lang)
-        audio_bytes_io = io.BytesIO()
-        tts.write_to_fp(audio_bytes_io)
-        audio_bytes_io.seek(0)
-        return audio_bytes_io.getvalue()
+        # Fixed phrases come pre-rendered; the rest is rendered in parallel sentence chunks
+        return synthesize_with_phrases(text, lang)
     except Exception as e:
-        st.warning(f"Audio generation failed: {e}")
+        logging.warning(f"Audio generation failed: {e}")
         return None
 
 # Get API key from environment variables (for Streamlit deployment)
 GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
 
-# Debug: Show API key status (without revealing the key)
-if GROQ_API_KEY:
-    st.info(f"🔑 API Key Status: Found (Length: {len(GROQ_API_KEY)} characters)")
-    if GROQ_API_KEY.startswith("gsk_"):
-        st.success("✅ API Key format looks correct (starts with 'gsk_')")
-    else:
-        st.warning("⚠️ API Key format may be incorrect (should start with 'gsk_')")
+# API key status (without revealing the key); the key is tested against the API at most every few minutes
+api_health = health_check()
+if api_health["api_key_valid"]:
+    st.success(f"✅ {api_health['message']}")
+elif api_health["api_key_found"]:
+    st.warning(f"⚠️ {api_health['message']}")
 else:
-    st.error("❌ No API key found! Please set GROQ_API_KEY environment variable in Streamlit deployment settings.")
+    st.error(f"❌ {api_health['message']}")
 
 LANGUAGE_CODES = {
     "English": "en",
@@ -67,7 +79,8 @@ TRANSLATIONS = {
         "earlier_symptoms": "Earlier symptoms / what problem are you facing?",
         "days_suffering": "Days suffering",
         "days_help": "From how many days are you suffering?",
-        "upload_image": "Upload Medical Image (Optional)",
+        "upload_image": "Upload Medical Images (Optional)",
+        "upload_video": "Or upload a short video (Optional)",
         "doctor_panel": "Your Doctor",
         "get_diagnosis": "🔍 Get Diagnosis",
         "language": "Language"
@@ -83,6 +96,7 @@ TRANSLATIONS = {
         "days_suffering": "कितने दिनों से",
         "days_help": "आप कितने दिनों से पीड़ित हैं?",
         "upload_image": "मेडिकल इमेज अपलोड करें (वैकल्पिक)",
+        "upload_video": "या एक छोटा वीडियो अपलोड करें (वैकल्पिक)",
         "doctor_panel": "आपके डॉक्टर",
         "get_diagnosis": "🔍 निदान प्राप्त करें",
         "language": "भाषा"
@@ -98,6 +112,7 @@ TRANSLATIONS = {
         "days_suffering": "किती दिवसांपासून",
         "days_help": "आपण किती दिवसांपासून त्रस्त आहात?",
         "upload_image": "वैद्यकीय प्रतिमा अपलोड करा (ऐच्छिक)",
+        "upload_video": "किंवा एक छोटा व्हिडिओ अपलोड करा (ऐच्छिक)",
         "doctor_panel": "आपले डॉक्टर",
         "get_diagnosis": "🔍 निदान मिळवा",
         "language": "भाषा"
@@ -155,7 +170,8 @@ with col1:
         with c2:
             st.number_input(tr("days_suffering"), min_value=0, step=1, help=tr("days_help"), key="duration_days_general", value=st.session_state.get("duration_days_general", 0))
     earlier_symptoms = st.text_area(tr("earlier_symptoms"), placeholder="List early signs or describe the specific problem type...", height=100)
-    image_input = st.file_uploader(tr("upload_image"), type=["jpg", "jpeg", "png", "webp"])
+    image_input = st.file_uploader(tr("upload_image"), type=["jpg", "jpeg", "png", "webp"], accept_multiple_files=True)
+    video_input = st.file_uploader(tr("upload_video"), type=["mp4", "mov", "m4v", "webm"])
     response_language = st.session_state.get("language", "English")
     submit_btn = st.button(tr("get_diagnosis"), width="stretch")
 
@@ -165,7 +181,7 @@ with col2:
 
 # Output section
 if submit_btn:
-    if not GROQ_API_KEY:
+    if not api_health["api_key_found"]:
         st.error("❌ Cannot proceed without API key. Please add GROQ_API_KEY to Streamlit secrets.")
     else:
         with st.spinner("Processing..."):
@@ -186,15 +202,13 @@ if submit_btn:
                     if text_input:
                         st.success(f"✅ Audio transcribed: {text_input[:100]}...")
                 
-                # Image input handling
-                image_base64 = None
-                if image_input is not None:
-                    temp_image = tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(image_input.name)[-1])
-                    temp_image.write(image_input.read())
-                    temp_image.close()
-                    image_base64 = encode_image(temp_image.name)
-                    os.remove(temp_image.name)
-                    st.success("🖼️ Image processed successfully")
+                # Image input handling: decoded straight from the uploads, no temporary files
+                encoded_images = encode_images(image_input) if image_input else []
+                if video_input is not None:
+                    # Only a handful of keyframes are decoded, never the whole clip
+                    encoded_images += encode_video_frames(video_input)
+                if encoded_images:
+                    st.success(f"🖼️ {len(encoded_images)} image(s) processed successfully")
                 
                 # Diagnosis logic
                 diagnosis = None
@@ -203,7 +217,7 @@ if submit_btn:
                 language_code = LANGUAGE_CODES.get(response_language, "en")
                 duration_val = st.session_state.get("duration_days_general", 0)
                 
-                if text_input and not image_base64:
+                if text_input and not encoded_images:
                     st.info("🧠 Analyzing text input...")
                     enriched_text = (
                         f"Patient report:\n"
@@ -217,27 +231,57 @@ if submit_btn:
                         f"4) Home care advice\n"
                         f"5) Prescription-style suggestions (OTC where appropriate)."
                     )
-                    diagnosis = analyze_text_query(enriched_text, response_language)
-                    prescription = generate_prescription(diagnosis, response_language)
-                elif image_base64:
+                    # Show the diagnosis as it streams in instead of waiting for the full answer
+                    diagnosis_preview = st.empty()
+                    diagnosis = ""
+                    for chunk in stream_text_query(enriched_text, response_language):
+                        diagnosis += chunk
+                        diagnosis_preview.markdown(f"<div class='diagnosis-card'>{diagnosis}</div>", unsafe_allow_html=True)
+                    diagnosis_preview.empty()
+                elif encoded_images:
                     st.info("🧠 Analyzing image...")
-                    image_prompt = (
-                        f"Analyze this image with the following patient context.\n\n"
-                        f"Patient report:\n"
-                        f"- Symptoms: {text_input or 'Not provided'}\n"
-                        f"- Earlier symptoms/problem: {earlier_symptoms}\n"
-                        f"- Duration (days): {duration_val}\n\n"
-                        f"Task: Provide a detailed medical assessment including differential diagnosis, likely diagnosis, red flags, home care, and prescription-style suggestions."
+                    # Every photo goes to the vision model in one request (or one montage)
+                    diagnosis = analyze_images_with_query(
+                        query=(
+                            f"Patient report:\n"
+                            f"- Symptoms: {text_input or 'Not provided'}\n"
+                            f"- Earlier symptoms/problem: {earlier_symptoms or 'Not provided'}\n"
+                            f"- Duration (days): {duration_val}"
+                        ),
+                        encoded_images=encoded_images,
+                        language=response_language,
+                        model="llama-3.2-11b-vision-preview"
                     )
-                    diagnosis = analyze_image_with_query(image_prompt, image_base64, response_language)
-                    prescription = generate_prescription(diagnosis, response_language)
                 
-                # Audio diagnosis and prescription
+                # Prescription and audio: the diagnosis audio does not wait for the prescription
                 audio_bytes = None
-                if diagnosis and prescription:
-                    full_text_for_audio = f"Diagnosis: {diagnosis}. Prescription: {prescription}"
-                    audio_bytes = generate_audio_from_text(full_text_for_audio, language_code)
-                    if audio_bytes:
+                if diagnosis:
+                    # The diagnosis is spoken sentence by sentence: its opening plays
+                    # while the remaining sentences and the prescription are prepared
+                    diagnosis_speech = ChunkedSpeech(f"Diagnosis: {diagnosis}.", language_code)
+                    graph = StageGraph()
+                    inputs = {"diagnosis": diagnosis}
+                    if prescription is None:
+                        graph.add("prescription", lambda diagnosis: generate_prescription(diagnosis, response_language),
+                                  deps=["diagnosis"], timeout=STAGE_TIMEOUT)
+                    else:
+                        inputs["prescription"] = prescription
+                    graph.add("diagnosis_audio", lambda diagnosis: diagnosis_speech.result(),
+                              deps=["diagnosis"], timeout=STAGE_TIMEOUT)
+                    graph.add("prescription_audio", lambda prescription: generate_audio_from_text(f"Prescription: {prescription}", language_code),
+                              deps=["prescription"], timeout=STAGE_TIMEOUT)
+                    try:
+                        st.caption("🎧 Diagnosis audio (the full recording follows below)")
+                        st.audio(diagnosis_speech.first(timeout=STAGE_TIMEOUT), format="audio/mp3")
+                    except Exception as e:
+                        logging.warning(f"Early audio failed: {e}")
+                    results = graph.run(**inputs)
+                    prescription = results.get("prescription", prescription)
+                    if "prescription" in graph.errors:
+                        st.warning(f"Prescription generation failed: {graph.errors['prescription']}")
+                    if results.get("diagnosis_audio") and results.get("prescription_audio"):
+                        # MP3 streams can be joined frame for frame
+                        audio_bytes = results["diagnosis_audio"] + results["prescription_audio"]
                         st.success("🎧 Audio generated successfully")
                 
                 # Output UI
@@ -6,6 +6,10 @@ import av
 import numpy as np
 import io
 from gtts import gTTS
+from replay_backend import install as install_backend
+from phrase_bank import synthesize_with_phrases, warm_up as warm_up_phrases
+install_backend()  # record/replay gTTS when AI_DOCTOR_BACKEND is set
+warm_up_phrases()  # pre-render disclaimers and prescription headings when PHRASE_BANK_WARM_UP=1
 
 # Configure WebRTC for cloud deployment
 RTC_CONFIGURATION = RTCConfiguration({
@@ -25,11 +29,8 @@ def generate_audio_from_text(text, lang):
             return None
         
         clean_text = text.strip()[:500]
-        tts = gTTS(text=clean_text, lang=lang, slow=False)
-        audio_bytes_io = io.BytesIO()
-        tts.write_to_fp(audio_bytes_io)
-        audio_bytes_io.seek(0)
-        audio_data = audio_bytes_io.getvalue()
+        # Fixed phrases come pre-rendered; the rest is rendered in parallel sentence chunks
+        audio_data = synthesize_with_phrases(clean_text, lang)
         
         if len(audio_data) > 0:
             return audio_data
@@ -301,19 +302,13 @@ with tab3:
     if uploaded_file is not None:
         st.image(uploaded_file, caption="Uploaded Image", use_column_width=True)
         
-        # Save uploaded file temporarily
-        import tempfile
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as tmp:
-            tmp.write(uploaded_file.getvalue())
-            tmp_path = tmp.name
-        
         try:
             # Get diagnosis from image
             diagnosis, prescription, recommendations = get_diagnosis_and_prescription(
                 symptoms="Image analysis",
                 duration_days=1,
                 language=language,
-                image_file=tmp_path
+                image_file=uploaded_file
             )
             
             st.markdown("### " + tr("diagnosis"))
@@ -327,12 +322,6 @@ with tab3:
             
         except Exception as e:
             st.error(f"Error processing image: {e}")
-        finally:
-            # Clean up temporary file
-            try:
-                os.unlink(tmp_path)
-            except:
-                pass
 
 # Footer
 st.markdown("---")
@@ -0,0 +1,78 @@
+# Audio formats for the voice layer: pick an output format per front end and check files by their headers
+import os
+
+# Formats the voice layer can hand out, with their MIME types
+MIME_TYPES = {"mp3": "audio/mpeg", "opus": "audio/ogg", "wav": "audio/wav"}
+EXTENSIONS = {".mp3": "mp3", ".ogg": "opus", ".opus": "opus", ".wav": "wav"}
+
+# Bytes read to identify a file; enough for an ID3 tag header plus the first MP3 frame header
+_HEADER_BYTES = 4096
+
+
+def format_for_path(path, default="mp3"):
+    """Audio format implied by a file name's extension"""
+    return EXTENSIONS.get(os.path.splitext(str(path))[1].lower(), default)
+
+
+def path_for_format(path, audio_format):
+    """path with its extension changed to match audio_format"""
+    extension = ".ogg" if audio_format == "opus" else f".{audio_format}"
+    return os.path.splitext(str(path))[0] + extension
+
+
+def negotiate(requested, available):
+    """The requested format if the engine can produce it, otherwise the engine's first (preferred) format"""
+    return requested if requested in available else available[0]
+
+
+def _mp3_frame(header):
+    """True if the 4 bytes look like an MPEG audio frame header"""
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return False
+    version = (header[1] >> 3) & 0x03
+    layer = (header[1] >> 1) & 0x03
+    bitrate = header[2] >> 4
+    sample_rate = (header[2] >> 2) & 0x03
+    return version != 0b01 and layer != 0b00 and bitrate != 0b1111 and sample_rate != 0b11
+
+
+def _id3_size(data):
+    """Length of a leading ID3v2 tag (10-byte header plus a 28-bit "syncsafe" size), or 0"""
+    if data[:3] != b"ID3" or len(data) < 10:
+        return 0
+    return 10 + ((data[6] & 0x7F) << 21 | (data[7] & 0x7F) << 14 | (data[8] & 0x7F) << 7 | (data[9] & 0x7F))
+
+
+def sniff(data):
+    """Format of audio bytes from their header ("mp3", "wav", "opus" or "ogg"), or None"""
+    if data[:4] == b"RIFF" and data[8:12] == b"WAVE":
+        return "wav" if b"fmt " in data[12:_HEADER_BYTES] else None
+    if data[:4] == b"OggS":
+        return "opus" if b"OpusHead" in data[:_HEADER_BYTES] else "ogg"
+    offset = _id3_size(data)
+    if _mp3_frame(data[offset:offset + 4]):
+        return "mp3"
+    return None
+
+
+def validate_audio(path, expected=None):
+    """Return the format of the audio file at path, raising ValueError if it is empty, unknown or not expected.
+
+    Only the header is read; nothing is decoded.
+    """
+    with open(path, "rb") as f:
+        data = f.read(_HEADER_BYTES)
+        tag = _id3_size(data)
+        if tag and tag + 4 > len(data):
+            # The first frame sits beyond a large tag (e.g. embedded artwork)
+            f.seek(tag)
+            audio_format = "mp3" if _mp3_frame(f.read(4)) else None
+        else:
+            audio_format = sniff(data)
+    if not data:
+        raise ValueError(f"Audio file {path} is empty")
+    if audio_format is None:
+        raise ValueError(f"Audio file {path} is not MP3, WAV or Ogg")
+    if expected and audio_format != expected:
+        raise ValueError(f"Audio file {path} is {audio_format}, expected {expected}")
+    return audio_format
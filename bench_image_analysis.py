@@ -0,0 +1,116 @@
+# Image analysis benchmark: decode time/peak memory and dominant-colour method speed on the repo's large photos
+import glob
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+MIN_BYTES = 1024 * 1024  # Only the multi-megabyte images
+RUNS = 5
+
+
+def legacy_decode(image_path, max_size=1000):
+    """The previous decode path: a grayscale read for the size, then a second colour read"""
+    import cv2
+    gray = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+    height, width = gray.shape
+    scale = max_size / max(height, width) if max(height, width) > max_size else 1.0
+    img = cv2.imread(image_path, cv2.IMREAD_REDUCED_COLOR_2 if scale < 0.5 else cv2.IMREAD_COLOR)
+    if scale < 1.0:
+        img = cv2.resize(img, (0, 0), fx=scale, fy=scale)
+    return img
+
+
+def current_decode(image_path, max_size=1000):
+    """The single-decode path used by analyze_image_colors"""
+    import cv2
+    from image_analysis import reduced_decode_flag, image_size
+    width, height = image_size(image_path)
+    img = cv2.imread(image_path, reduced_decode_flag(width, height, max_size))
+    if max(img.shape[:2]) > max_size:
+        scale = max_size / max(img.shape[:2])
+        img = cv2.resize(img, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return img
+
+
+DECODERS = {"legacy": legacy_decode, "current": current_decode}
+
+
+def child(name, image_path):
+    """Run one decode in this (fresh) process and report its time and peak RSS growth"""
+    import cv2  # noqa: F401  (import cost is not part of the measurement)
+    import image_analysis  # noqa: F401
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    DECODERS[name](image_path)
+    elapsed = time.perf_counter() - started
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    print(json.dumps({"ms": elapsed * 1000, "peak_mb": (after - before) * unit / 2 ** 20}))
+
+
+def measure(name, image_path):
+    """Median time and peak memory over RUNS fresh processes"""
+    samples = []
+    for _ in range(RUNS):
+        result = subprocess.run(
+            [sys.executable, __file__, "--child", name, image_path],
+            cwd=ROOT, capture_output=True, text=True, check=True,
+        )
+        samples.append(json.loads(result.stdout))
+    return (statistics.median(s["ms"] for s in samples),
+            statistics.median(s["peak_mb"] for s in samples))
+
+
+def compare_methods(image_path, max_size=1000):
+    """Median ms per dominant-colour method on one decoded image, and whether repeated runs agree"""
+    from image_analysis import METHODS, _load_for_analysis, analyze_image_colors
+    import image_analysis
+    img, _, _ = _load_for_analysis(image_path, max_size)
+    # Time the clustering alone: hand every run the already decoded image
+    real_load = image_analysis._load_for_analysis
+    image_analysis._load_for_analysis = lambda *args: (img, 0, 0)
+    try:
+        rows = []
+        for method in METHODS:
+            times, outputs = [], set()
+            for _ in range(RUNS):
+                started = time.perf_counter()
+                # minibatch is only reproducible with a fixed seed, which is how callers use it
+                result = analyze_image_colors(image_path, max_size, method=method,
+                                              seed=0 if method == "minibatch" else None)
+                times.append((time.perf_counter() - started) * 1000)
+                outputs.add(tuple(result["dominant_colors"]))
+            rows.append((method, statistics.median(times), len(outputs) == 1, result["dominant_colors"]))
+        return rows
+    finally:
+        image_analysis._load_for_analysis = real_load
+
+
+def main():
+    images = sys.argv[1:] or sorted(
+        path for path in glob.glob(os.path.join(ROOT, "*.jpg")) if os.path.getsize(path) >= MIN_BYTES
+    )
+    print(f"{'image':40} {'MB':>5} {'decoder':>8} {'ms':>8} {'peak MB':>8}")
+    for path in images:
+        size_mb = os.path.getsize(path) / 2 ** 20
+        for name in DECODERS:
+            ms, peak = measure(name, path)
+            print(f"{os.path.basename(path)[:40]:40} {size_mb:5.1f} {name:>8} {ms:8.1f} {peak:8.1f}")
+
+    print(f"\n{'image':40} {'method':>10} {'ms':>8} {'stable':>7}  colours")
+    for path in images:
+        for method, ms, stable, colours in compare_methods(path):
+            print(f"{os.path.basename(path)[:40]:40} {method:>10} {ms:8.1f} {str(stable):>7}  {' '.join(colours)}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--child":
+        child(sys.argv[2], sys.argv[3])
+    else:
+        main()
@@ -0,0 +1,58 @@
+# Startup benchmark: how long does importing brain_of_the_doctor take?
+import os
+import statistics
+import subprocess
+import sys
+
+MODULE = "brain_of_the_doctor"
+RUNS = 5
+
+
+def import_cost_ms(module):
+    """Import a module in a fresh interpreter; return (total ms, slowest direct imports)"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    # Lines look like "import time: self [us] | cumulative | <indent>package";
+    # the indent grows by two spaces per level and children precede parents
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        timings.append((int(cumulative_us), depth, name.strip()))
+
+    index = next(i for i, (_, _, name) in enumerate(timings) if name == module)
+    total, depth, _ = timings[index]
+    direct = []
+    for us, d, name in reversed(timings[:index]):
+        if d <= depth:
+            break
+        if d == depth + 1:
+            direct.append((us, name))
+    return total / 1000, sorted(direct, reverse=True)[:5]
+
+
+def main():
+    module = sys.argv[1] if len(sys.argv) > 1 else MODULE
+    costs = []
+    for _ in range(RUNS):
+        total_ms, top = import_cost_ms(module)
+        costs.append(total_ms)
+
+    print(f"import {module}: median {statistics.median(costs):.1f} ms "
+          f"(min {min(costs):.1f}, max {max(costs):.1f}, {RUNS} runs)")
+    print("Slowest direct imports in the last run:")
+    for us, name in top:
+        print(f"  {us / 1000:8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,32 +2,54 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import os
-import sys
 import base64
+import logging
 import time
 import hashlib
-import shutil
-import tempfile
-from functools import lru_cache
-from groq import Groq, GroqError
+import json
+import threading
+from diagnosis_cache import get_cache, make_key, normalize_query
+# groq/httpx are imported lazily by groq_client so importing this module stays cheap
+from groq_client import get_client, get_async_client, resolve_api_key
+from rate_limiter import groq_call, groq_call_async
+from single_flight import SingleFlight
 
 # Try to get API key from environment variables first
 GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
 
-def get_api_key():
-    """Get API key from Streamlit secrets or environment variables"""
-    try:
-        import streamlit as st
-        return st.secrets["GROQ_API_KEY"]
-    except (ImportError, KeyError, AttributeError):
-        return os.environ.get("GROQ_API_KEY")
+# Bump whenever a prompt changes so answers cached under older prompts are not reused
+PROMPT_VERSION = "2"
+
+# Bump whenever encode_image's output changes so stale encodings are not reused
+ENCODE_VERSION = "2"
+
+# Limits for encode_image's byte-budget search
+JPEG_MIN_QUALITY = 40
+JPEG_MAX_QUALITY = 90
+MIN_IMAGE_SIDE = 64
+
+# Photos per vision request (Groq's vision models take up to five); more are tiled into a montage
+VISION_MAX_IMAGES = int(os.environ.get("VISION_MAX_IMAGES", "5"))
+# Side of one montage cell in pixels
+MONTAGE_TILE = 256
+# Model that sees the photo when a consultation includes one
+VISION_MODEL = "llama-3.2-11b-vision-preview"
+
+# Seconds a health_check() result is reused before the API is contacted again
+HEALTH_CHECK_TTL = 300
+
+# Concurrent identical analyses (same cache key) share one API call
+_analyses = SingleFlight("analyses")
+
+_health_lock = threading.Lock()
+_health = {"result": None, "checked_at": 0.0}
 
 def test_api_key(api_key):
     """Test if the provided API key is valid by making a minimal request"""
     try:
-        client = Groq(api_key=api_key)
+        client = get_client(api_key)
         # Make a minimal request to list available models or similar
-        models = client.models.list()
+        models = groq_call(client.models.list, tokens=0, max_retries=1)
         print("Available models:", [model.id for model in models.data])
         if models:
             return True
@@ -36,48 +58,250 @@ def test_api_key(api_key):
         print(f"API key test failed: {str(e)}")
         return False
 
-def handle_long_path(file_path):
-    """Handle long file paths by creating a shorter temporary path"""
+def health_check(force=False, ttl=HEALTH_CHECK_TTL):
+    """Validate the GROQ API key once and cache the result for ttl seconds.
+
+    Replaces the check that used to run at import time; nothing here is
+    called unless a front end asks for it.
+    """
+    with _health_lock:
+        cached = _health["result"]
+        if not force and cached is not None and time.time() - _health["checked_at"] < ttl:
+            return cached
+
+        api_key = resolve_api_key()
+        result = {
+            "api_key_found": bool(api_key),
+            "api_key_format_ok": bool(api_key) and api_key.startswith("gsk_"),
+            "api_key_valid": False,
+            "message": "",
+        }
+        if not api_key:
+            result["message"] = (
+                "GROQ_API_KEY not found. Set it in Streamlit secrets, the environment "
+                "or a .env file. You can get an API key from: https://console.groq.com/"
+            )
+        elif test_api_key(api_key):
+            result["api_key_valid"] = True
+            result["message"] = "API Key is valid and working!"
+        else:
+            result["message"] = "API Key test failed - key may be invalid or expired"
+        if api_key and not result["api_key_format_ok"]:
+            result["message"] += " (API Key format may be incorrect, should start with 'gsk_')"
+
+        _health["result"] = result
+        _health["checked_at"] = time.time()
+        return result
+
+def _image_bytes(image):
+    """Raw bytes of an image given as a path, bytes or a file-like object.
+
+    File-like covers Streamlit's UploadedFile (getvalue) and open files or
+    buffers (read); Gradio file objects are handled through their path.
+    """
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return bytes(image)
+    if hasattr(image, "getvalue"):
+        return image.getvalue()
+    if hasattr(image, "read"):
+        if hasattr(image, "seek"):
+            image.seek(0)
+        return image.read()
+    # Python's open() copes with long Windows paths that cv2.imread cannot
+    path = image if isinstance(image, (str, os.PathLike)) else getattr(image, "name", image)
+    with open(path, "rb") as image_file:
+        return image_file.read()
+
+def image_digest(image):
+    """SHA-256 of an image's content (raw file bytes, or the pixels of a numpy array)"""
+    import numpy as np
+    if isinstance(image, np.ndarray):
+        digest = hashlib.sha256(f"{image.shape}{image.dtype}".encode("utf-8"))
+        digest.update(np.ascontiguousarray(image).data)
+        return digest.hexdigest()
+    return hashlib.sha256(_image_bytes(image)).hexdigest()
+
+def _decode_image(data):
+    """Decode image bytes to an upright BGR array: OpenCV first, then PIL for formats it lacks"""
+    import cv2
+    import numpy as np
+    # Both decoders apply the EXIF orientation; the JPEG written afterwards carries no EXIF
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if img is not None:
+        return img
+    import io
+    from PIL import Image, ImageOps
+    with Image.open(io.BytesIO(data)) as pil_image:
+        rgb = ImageOps.exif_transpose(pil_image).convert("RGB")
+    return cv2.cvtColor(np.asarray(rgb), cv2.COLOR_RGB2BGR)
+
+def _decode_flag(data, max_size):
+    """Let libjpeg shrink big photos while decoding when max_size allows it"""
+    import io
+    import cv2
+    from image_analysis import image_size, reduced_decode_flag
     try:
-        # Create a temporary directory
-        temp_dir = tempfile.mkdtemp()
-        # Get the file extension
-        _, ext = os.path.splitext(file_path)
-        # Create a new shorter path
-        new_path = os.path.join(temp_dir, f"temp{ext}")
-        # Copy the file to the new location
-        shutil.copy2(file_path, new_path)
-        return new_path
-    except Exception as e:
-        print(f"Error handling long path: {str(e)}")
-        return file_path
+        width, height = image_size(io.BytesIO(data))
+    except Exception:
+        return cv2.IMREAD_COLOR
+    return reduced_decode_flag(width, height, max_size)
 
-def encode_image(image_path, max_size=256):
-    """Convert image to base64 string with optional resizing"""
+def _base64_size(n):
+    return 4 * ((n + 2) // 3)
+
+def _fit_jpeg(img, max_size, max_bytes):
+    """Largest size (up to max_size), then highest quality, whose base64 JPEG fits max_bytes.
+
+    Returns (image, jpeg buffer, quality), or None if even the smallest size does not fit.
+    """
+    import cv2
+    side = max(img.shape[:2])
+    if side > max_size:
+        # Shrink once up front; the smaller sizes below are cut from this copy
+        scale = max_size / side
+        img = cv2.resize(img, (0,0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        side = max(img.shape[:2])
+    target = side
+    while True:
+        scaled = img
+        if side > target:
+            scale = target / side
+            scaled = cv2.resize(img, (0,0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        # Binary search for the highest quality that fits at this size
+        low, high, best = JPEG_MIN_QUALITY, JPEG_MAX_QUALITY, None
+        while low <= high:
+            quality = (low + high) // 2
+            _, buffer = cv2.imencode('.jpg', scaled, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if _base64_size(len(buffer)) <= max_bytes:
+                best = (scaled, buffer, quality)
+                low = quality + 1
+            else:
+                high = quality - 1
+        if best is not None:
+            return best
+        if target <= MIN_IMAGE_SIDE:
+            return None
+        # Nothing fits at this size: shrink and try again
+        target = max(MIN_IMAGE_SIDE, int(target * 0.75))
+
+def encode_image_report(image, max_size=256, max_bytes=None):
+    """encode_image plus details: {"encoded", "bytes", "width", "height", "quality", "source"}.
+
+    Without max_bytes the image is resized to max_size and saved at JPEG
+    quality 60. With max_bytes (the length of the base64 payload) the
+    largest size up to max_size and then the highest quality that fit are
+    chosen. "source" is "opencv", "pil" or "original" (undecodable bytes
+    passed through, only when they fit the budget).
+    """
+    import numpy as np
+    if isinstance(image, np.ndarray):
+        data = None
+        digest = image_digest(image)
+    else:
+        data = _image_bytes(image)
+        digest = hashlib.sha256(data).hexdigest()
+
+    cache_key = make_key("encoded", ENCODE_VERSION, digest, max_size, max_bytes)
+    cached = get_cache().get(cache_key)
+    if cached is not None:
+        return json.loads(cached)
+
+    import cv2
     try:
-        # Handle long paths
-        image_path = handle_long_path(image_path)
-        
-        import cv2
-        # Read and optionally resize image
-        img = cv2.imread(image_path)
-        if img is None:
-            raise ValueError("Could not read image file")
-            
+        if data is None:
+            # Gradio hands decoded images over as RGB
+            img = cv2.cvtColor(image, cv2.COLOR_RGB2BGR) if image.ndim == 3 else image
+            source = "opencv"
+        else:
+            img = cv2.imdecode(np.frombuffer(data, np.uint8), _decode_flag(data, max_size))
+            source = "opencv"
+            if img is None:
+                img = _decode_image(data)
+                source = "pil"
+    except Exception as e:
+        # Neither decoder understands it: pass the bytes through only if they are small enough
+        if data is None or (max_bytes and _base64_size(len(data)) > max_bytes):
+            raise ValueError(f"Could not decode image: {str(e)}")
+        encoded = base64.b64encode(data).decode('utf-8')
+        return {"encoded": encoded, "bytes": len(encoded), "width": None, "height": None,
+                "quality": None, "source": "original"}
+
+    if max_bytes:
+        fitted = _fit_jpeg(img, max_size, max_bytes)
+        if fitted is None:
+            raise ValueError(f"Image cannot be encoded within {max_bytes} bytes")
+        img, buffer, quality = fitted
+    else:
         height, width = img.shape[:2]
         if max(height, width) > max_size:
             scale = max_size / max(height, width)
             img = cv2.resize(img, (0,0), fx=scale, fy=scale)
-            
         # Encode with lower quality
-        _, buffer = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 60])
-        encoded = base64.b64encode(buffer).decode('utf-8')
-        return encoded
-        
-    except Exception:
-        # Fallback to original method if OpenCV fails
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
+        quality = 60
+        _, buffer = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+
+    encoded = base64.b64encode(buffer).decode('utf-8')
+    height, width = img.shape[:2]
+    report = {"encoded": encoded, "bytes": len(encoded), "width": width, "height": height,
+              "quality": quality, "source": source}
+    logging.info(f"Encoded image: {width}x{height} at quality {quality}, {len(encoded)} bytes")
+    get_cache().set(cache_key, json.dumps(report))
+    return report
+
+def encode_image(image, max_size=256, max_bytes=None):
+    """Convert image to base64 string with optional resizing.
+
+    image may be a file path, raw bytes, a file-like object (e.g. a Streamlit
+    upload) or an already decoded numpy array; nothing is copied to disk.
+    Pass max_bytes to cap the base64 payload instead of using a fixed
+    quality (see encode_image_report). Results are cached by content hash,
+    so a re-uploaded photo is not decoded and re-encoded again.
+    """
+    return encode_image_report(image, max_size, max_bytes)["encoded"]
+
+def encode_images(images, max_size=256, max_bytes=None):
+    """encode_image for several photos at once, returned in input order.
+
+    OpenCV releases the GIL while decoding and encoding, so the photos are
+    processed on a small thread pool rather than one after another.
+    """
+    images = list(images)
+    if len(images) <= 1:
+        return [encode_image(image, max_size, max_bytes) for image in images]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=min(len(images), 8)) as pool:
+        return list(pool.map(lambda image: encode_image(image, max_size, max_bytes), images))
+
+def montage_images(encoded_images, tile=MONTAGE_TILE, max_bytes=None):
+    """Tile base64 JPEGs into one numbered grid image (base64 JPEG) for single-image backends"""
+    import math
+    import cv2
+    import numpy as np
+    count = len(encoded_images)
+    columns = math.ceil(math.sqrt(count))
+    rows = math.ceil(count / columns)
+    sheet = np.full((rows * tile, columns * tile, 3), 255, np.uint8)
+    for i, encoded in enumerate(encoded_images):
+        img = cv2.imdecode(np.frombuffer(base64.b64decode(encoded), np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError(f"Could not decode image {i + 1} for the montage")
+        scale = tile / max(img.shape[:2])
+        img = cv2.resize(img, (0,0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        # Centre each photo in its cell and number it so the analysis can refer to it
+        height, width = img.shape[:2]
+        top = (i // columns) * tile + (tile - height) // 2
+        left = (i % columns) * tile + (tile - width) // 2
+        sheet[top:top + height, left:left + width] = img
+        cv2.putText(sheet, str(i + 1), ((i % columns) * tile + 8, (i // columns) * tile + 28),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 0, 255), 2)
+    if max_bytes:
+        fitted = _fit_jpeg(sheet, max(sheet.shape[:2]), max_bytes)
+        if fitted is None:
+            raise ValueError(f"Montage cannot be encoded within {max_bytes} bytes")
+        buffer = fitted[1]
+    else:
+        _, buffer = cv2.imencode('.jpg', sheet, [cv2.IMWRITE_JPEG_QUALITY, 60])
+    return base64.b64encode(buffer).decode('utf-8')
 
 PRESCRIPTION_TEMPLATE = """
 PRESCRIPTION
@@ -94,20 +318,86 @@ Instructions:
 Doctor: AI Doctor
 """
 
+# Fixed text that appears in responses word for word (phrase_bank pre-renders its speech)
+ANALYSIS_NOTES = {
+    "English": "Note: This analysis is based on your description. For more accurate diagnosis, please consult a healthcare professional.",
+    "Hindi": "नोट: यह विश्लेषण आपके विवरण के आधार पर है। अधिक सटीक निदान के लिए, कृपया एक स्वास्थ्य देखभाल पेशेवर से परामर्श करें।",
+    "Marathi": "टीप: हे विश्लेषण तुमच्या वर्णनावर आधारित आहे. अधिक अचूक निदानासाठी, कृपया वैद्यकीय व्यावसायिकांशी सल्लामसलत करा."
+}
+
+# Medications shown when the model's list cannot be parsed, and when the request failed
+FALLBACK_MEDICATIONS = {
+    "English": ["Consult healthcare professional for specific medication"],
+    "Hindi": ["विशिष्ट दवा के लिए स्वास्थ्य देखभाल पेशेवर से परामर्श करें"],
+    "Marathi": ["विशिष्ट औषधासाठी आरोग्यसेवा व्यावसायिकांचा सल्ला घ्या"]
+}
+ERROR_MEDICATIONS = {
+    "English": ["Consult healthcare professional for medication"],
+    "Hindi": ["दवा के लिए स्वास्थ्य देखभाल पेशेवर से परामर्श करें"],
+    "Marathi": ["औषधासाठी आरोग्यसेवा व्यावसायिकांचा सल्ला घ्या"]
+}
+
+PRESCRIPTION_TEMPLATES = {
+    "English": """
+PRESCRIPTION
+Date: {date}
+Patient: [Patient Name]
+Diagnosis: {diagnosis}
+
+Medications:
+{medications}
+
+Doctor: AI Doctor
+""",
+    "Hindi": """
+नुस्खा
+दिनांक: {date}
+रोगी: [रोगी का नाम]
+निदान: {diagnosis}
+
+दवाइयां:
+{medications}
+
+डॉक्टर: AI Doctor
+""",
+    "Marathi": """
+औषधोपचार
+दिनांक: {date}
+रुग्ण: [रुग्णाचे नाव]
+निदान: {diagnosis}
+
+औषधे:
+{medications}
+
+डॉक्टर: AI Doctor
+"""
+}
+
 import random
 
-def generate_prescription(diagnosis, language="English"):
-    """Generate a prescription based on diagnosis using AI to suggest medications."""
-    from datetime import datetime
+def _groq_error():
+    """GroqError, imported on first use to keep module import cheap"""
+    from groq import GroqError
+    return GroqError
 
-    if not diagnosis or not isinstance(diagnosis, str):
-        raise ValueError("Diagnosis must be a non-empty string")
+def _cache_key(kind, query, language, model, *extra):
+    """Key for the persistent diagnosis cache"""
+    return make_key(kind, normalize_query(query), language, model, PROMPT_VERSION, *extra)
 
-    date = datetime.now().strftime("%d/%m/%Y")
-    
-    # Use AI to generate appropriate medications based on the diagnosis
-    client = Groq(api_key=get_api_key())
-    
+def _remember(cache_key, result):
+    """Store a successful analysis in the persistent cache and return it"""
+    if isinstance(result, str) and result.strip() and not result.startswith(
+        ("Error:", "Text analysis failed", "Vision analysis failed")
+    ):
+        get_cache().set(cache_key, result)
+    return result
+
+def coalescing_stats():
+    """Counters for analyses that joined an identical in-flight request instead of calling the API"""
+    return _analyses.stats()
+
+def _prescription_messages(diagnosis, language):
+    """Build the chat messages asking the model for medications"""
     # Language-specific prompts for medication generation with detailed instructions
     medication_prompts = {
         "English": """Based on the following medical diagnosis, provide 2-3 appropriate medications or treatments with specific instructions for each.
@@ -141,98 +431,53 @@ def generate_prescription(diagnosis, language="English"):
     prompt_template = medication_prompts.get(language, medication_prompts["English"])
     prompt = prompt_template.format(diagnosis=diagnosis[:500])  # Limit diagnosis length
     
-    try:
-        response = client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": "You are a medical professional providing medication recommendations."},
-                {"role": "user", "content": prompt}
-            ],
-            model="llama-3.1-8b-instant",
-            max_tokens=150,
-            temperature=0.3
-        )
-        
-        medications_text = response.choices[0].message.content.strip()
-        
-        # Parse the medications from the response
-        medications = []
-        lines = medications_text.split('\n')
-        
-        for line in lines:
-            line = line.strip()
-            # Skip empty lines and lines that are just headers
-            if not line or any(phrase in line.lower() for phrase in ["here is", "medications:", "list of", "following"]):
-                continue
-            
-            # Handle different list formats
-            if line.startswith(('-', '•', '*', '1.', '2.', '3.')):
-                # Clean up list items
-                clean_med = line.replace('-', '').replace('•', '').replace('*', '').strip()
-                # Remove numbering
-                if clean_med and clean_med[0].isdigit() and '.' in clean_med:
-                    clean_med = clean_med.split('.', 1)[1].strip()
-                if clean_med and len(clean_med) > 3:
-                    medications.append(clean_med)
-            else:
-                # Handle plain text medication names
-                if len(line) > 3 and not any(word in line.lower() for word in ["medication", "treatment", "prescription"]):
-                    medications.append(line)
-        
-        # If parsing failed, use fallback medications
-        if not medications:
-            fallback_meds = {
-                "English": ["Consult healthcare professional for specific medication"],
-                "Hindi": ["विशिष्ट दवा के लिए स्वास्थ्य देखभाल पेशेवर से परामर्श करें"],
-                "Marathi": ["विशिष्ट औषधासाठी आरोग्यसेवा व्यावसायिकांचा सल्ला घ्या"]
-            }
-            medications = fallback_meds.get(language, fallback_meds["English"])
-            
-    except Exception as e:
-        print(f"Medication generation failed: {str(e)}")
-        fallback_meds = {
-            "English": ["Consult healthcare professional for medication"],
-            "Hindi": ["दवा के लिए स्वास्थ्य देखभाल पेशेवर से परामर्श करें"],
-            "Marathi": ["औषधासाठी आरोग्यसेवा व्यावसायिकांचा सल्ला घ्या"]
-        }
-        medications = fallback_meds.get(language, fallback_meds["English"])
-
-    templates = {
-        "English": """
-PRESCRIPTION
-Date: {date}
-Patient: [Patient Name]
-Diagnosis: {diagnosis}
-
-Medications:
-{medications}
-
-Doctor: AI Doctor
-""",
-        "Hindi": """
-नुस्खा
-दिनांक: {date}
-रोगी: [रोगी का नाम]
-निदान: {diagnosis}
+    return [
+        {"role": "system", "content": "You are a medical professional providing medication recommendations."},
+        {"role": "user", "content": prompt}
+    ]
 
-दवाइयां:
-{medications}
+def _parse_medications(medications_text, language):
+    """Parse the model's medication list, falling back to a generic line"""
+    # Parse the medications from the response
+    medications = []
+    lines = medications_text.split('\n')
+    
+    for line in lines:
+        line = line.strip()
+        # Skip empty lines and lines that are just headers
+        if not line or any(phrase in line.lower() for phrase in ["here is", "medications:", "list of", "following"]):
+            continue
+        
+        # Handle different list formats
+        if line.startswith(('-', '•', '*', '1.', '2.', '3.')):
+            # Clean up list items
+            clean_med = line.replace('-', '').replace('•', '').replace('*', '').strip()
+            # Remove numbering
+            if clean_med and clean_med[0].isdigit() and '.' in clean_med:
+                clean_med = clean_med.split('.', 1)[1].strip()
+            if clean_med and len(clean_med) > 3:
+                medications.append(clean_med)
+        else:
+            # Handle plain text medication names
+            if len(line) > 3 and not any(word in line.lower() for word in ["medication", "treatment", "prescription"]):
+                medications.append(line)
+    
+    # If parsing failed, use fallback medications
+    if not medications:
+        medications = list(FALLBACK_MEDICATIONS.get(language, FALLBACK_MEDICATIONS["English"]))
+    return medications
 
-डॉक्टर: AI Doctor
-""",
-        "Marathi": """
-औषधोपचार
-दिनांक: {date}
-रुग्ण: [रुग्णाचे नाव]
-निदान: {diagnosis}
+def _error_medications(language):
+    """Medications shown when the medication request itself failed"""
+    return list(ERROR_MEDICATIONS.get(language, ERROR_MEDICATIONS["English"]))
 
-औषधे:
-{medications}
+def _format_prescription(diagnosis, medications, language):
+    """Render the prescription template for the given medications"""
+    from datetime import datetime
 
-डॉक्टर: AI Doctor
-"""
-    }
+    date = datetime.now().strftime("%d/%m/%Y")
 
-    template = templates.get(language, templates["English"])
+    template = PRESCRIPTION_TEMPLATES.get(language, PRESCRIPTION_TEMPLATES["English"])
 
     return template.format(
         date=date,
@@ -240,20 +485,53 @@ Doctor: AI Doctor
         medications="\n".join(f"- {med}" for med in medications),
     )
 
-@lru_cache(maxsize=100)
-def analyze_image_with_query(query, encoded_image, language="English", model="llama3.1-8b-instant"):
-    """Analyze image with text query using GROQ's vision model with caching"""
-    import logging
-    if not query or not encoded_image:
-        logging.error("Missing required parameters for analyze_image_with_query")
-        return "Error: Missing required parameters for image analysis."
-        
-    client = Groq(api_key=get_api_key())
-    
-    # Since llama3-8b-8192 doesn't support vision, we'll analyze the text query
-    # and provide guidance based on the image context
-    logging.info("Vision model not available, falling back to text analysis with image context")
+def generate_prescription(diagnosis, language="English"):
+    """Generate a prescription based on diagnosis using AI to suggest medications."""
+    if not diagnosis or not isinstance(diagnosis, str):
+        raise ValueError("Diagnosis must be a non-empty string")
+
+    # Use AI to generate appropriate medications based on the diagnosis
+    client = get_client()
     
+    try:
+        response = groq_call(
+            client.chat.completions.create,
+            messages=_prescription_messages(diagnosis, language),
+            model="llama-3.1-8b-instant",
+            max_tokens=150,
+            temperature=0.3
+        )
+        medications = _parse_medications(response.choices[0].message.content.strip(), language)
+    except Exception as e:
+        print(f"Medication generation failed: {str(e)}")
+        medications = _error_medications(language)
+
+    return _format_prescription(diagnosis, medications, language)
+
+async def generate_prescription_async(diagnosis, language="English"):
+    """Async version of generate_prescription using the shared async client"""
+    if not diagnosis or not isinstance(diagnosis, str):
+        raise ValueError("Diagnosis must be a non-empty string")
+
+    client = get_async_client()
+
+    try:
+        response = await groq_call_async(
+            client.chat.completions.create,
+            messages=_prescription_messages(diagnosis, language),
+            model="llama-3.1-8b-instant",
+            max_tokens=150,
+            temperature=0.3
+        )
+        medications = _parse_medications(response.choices[0].message.content.strip(), language)
+    except Exception as e:
+        print(f"Medication generation failed: {str(e)}")
+        medications = _error_medications(language)
+
+    return _format_prescription(diagnosis, medications, language)
+
+def _image_query_messages(query, language, attached=False):
+    """Build the chat messages for an image-based analysis; attached means the photos go with them"""
     # Language-specific prompts for image-based analysis
     language_prompts = {
         "English": """You are a dermatology specialist AI assistant. A patient has uploaded an image of their skin condition and provided the following description. 
@@ -357,7 +635,14 @@ def analyze_image_with_query(query, encoded_image, language="English", model="ll
     system_prompt = f"{system_prompt} {language_instructions.get(language, 'Respond in English only.')}"
     
     # Create a comprehensive query that includes image context
-    enhanced_query = f"""Patient has uploaded an image of their skin condition and reports: {query}
+    if attached:
+        enhanced_query = f"""Patient has uploaded an image of their skin condition and reports: {query}
+    
+    Please provide a detailed medical analysis based on what you see in the image and their description. Consider common skin conditions that match both.
+    
+    Focus on providing helpful medical guidance."""
+    else:
+        enhanced_query = f"""Patient has uploaded an image of their skin condition and reports: {query}
     
     Please provide a detailed medical analysis based on their description. Consider common skin conditions that match their symptoms.
     
@@ -373,28 +658,97 @@ def analyze_image_with_query(query, encoded_image, language="English", model="ll
             "content": enhanced_query
         }
     ]
+    return messages
+
+def _image_query_result(response, language):
+    """Validate the image analysis response and append the method note"""
+    content = response.choices[0].message.content
+    if not isinstance(content, str):
+        content = str(content)
+    if not content.strip():
+        logging.error("Empty response content from analyze_image_with_query")
+        return "Error: Empty response from image analysis."
+
+    # Add a note about the analysis method
+    return content + "\n\n" + ANALYSIS_NOTES.get(language, ANALYSIS_NOTES["English"])
+
+def _image_cache_key(query, encoded_image, language, model):
+    # The encoded payload is itself cached by image content, so equal photos give equal keys
+    payload_digest = hashlib.sha256(encoded_image.encode("utf-8")).hexdigest()
+    return _cache_key("image", query, language, model, payload_digest)
+
+def _similar_image_result(query, encoded_image, language, model):
+    """Cached analysis of a near-duplicate of this image for the same prompt, if there is one"""
+    try:
+        from image_hash import encoded_image_hash, get_index
+        found = get_index().lookup(
+            _cache_key("image-scope", query, language, model),
+            encoded_image_hash(encoded_image),
+            resolve=get_cache().get,
+        )
+    except Exception as e:
+        logging.warning(f"Near-duplicate lookup failed: {str(e)}")
+        return None
+    return found[0] if found else None
+
+def _index_image(cache_key, query, encoded_image, language, model):
+    """Make a freshly cached analysis findable by near-duplicate uploads"""
+    if get_cache().get(cache_key) is None:
+        # Failures are not cached, so there is nothing to point at
+        return
+    try:
+        from image_hash import encoded_image_hash, get_index
+        get_index().add(_cache_key("image-scope", query, language, model), encoded_image_hash(encoded_image), cache_key)
+    except Exception as e:
+        logging.warning(f"Near-duplicate indexing failed: {str(e)}")
+
+def near_duplicate_stats():
+    """Lookups, matches and additions of the near-duplicate image index"""
+    from image_hash import get_index
+    return get_index().stats()
+
+def analyze_image_with_query(query, encoded_image, language="English", model="llama3.1-8b-instant",
+                             reuse_similar=True):
+    """Analyze image with text query using GROQ's vision model with caching.
+
+    reuse_similar=False only reuses analyses of this exact image; pass it when
+    query is a fixed prompt rather than the patient's own words, since the
+    prompt then does not tell two patients' similar photos apart.
+    """
+    import logging
+    if not query or not encoded_image:
+        logging.error("Missing required parameters for analyze_image_with_query")
+        return "Error: Missing required parameters for image analysis."
+
+    cache_key = _image_cache_key(query, encoded_image, language, model)
+    cached = get_cache().get(cache_key)
+    if cached is not None:
+        return cached
+    similar = _similar_image_result(query, encoded_image, language, model) if reuse_similar else None
+    if similar is not None:
+        return similar
+    result = _analyses.do(cache_key, _analyze_image_uncached, cache_key, query, language, model)
+    if reuse_similar:
+        _index_image(cache_key, query, encoded_image, language, model)
+    return result
+
+def _analyze_image_uncached(cache_key, query, language, model):
+    client = get_client()
+    
+    # Since llama3-8b-8192 doesn't support vision, we'll analyze the text query
+    # and provide guidance based on the image context
+    logging.info("Vision model not available, falling back to text analysis with image context")
+    
+    messages = _image_query_messages(query, language)
     
     try:
-        response = client.chat.completions.create(
+        response = groq_call(
+            client.chat.completions.create,
             messages=messages,
             model=model,
             max_tokens=800
         )
-        content = response.choices[0].message.content
-        if not isinstance(content, str):
-            content = str(content)
-        if not content.strip():
-            logging.error("Empty response content from analyze_image_with_query")
-            return "Error: Empty response from image analysis."
-        
-        # Add a note about the analysis method
-        note = {
-            "English": "\n\nNote: This analysis is based on your description. For more accurate diagnosis, please consult a healthcare professional.",
-            "Hindi": "\n\nनोट: यह विश्लेषण आपके विवरण के आधार पर है। अधिक सटीक निदान के लिए, कृपया एक स्वास्थ्य देखभाल पेशेवर से परामर्श करें।",
-            "Marathi": "\n\nटीप: हे विश्लेषण तुमच्या वर्णनावर आधारित आहे. अधिक अचूक निदानासाठी, कृपया वैद्यकीय व्यावसायिकांशी सल्लामसलत करा."
-        }
-        
-        return content + note.get(language, note["English"])
+        return _remember(cache_key, _image_query_result(response, language))
         
     except Exception as e:
         logging.error(f"Vision analysis failed: {str(e)}")
@@ -402,51 +756,166 @@ def analyze_image_with_query(query, encoded_image, language="English", model="ll
             return analyze_text_query(query, language)
         return f"Vision analysis failed: {str(e)}"
 
-# Validate GROQ API key
-if not GROQ_API_KEY:
-    error_msg = """
-    ERROR: GROQ_API_KEY not found. Please make sure it's set in:
-    1. Streamlit secrets (for deployment) - st.secrets["GROQ_API_KEY"]
-    2. Environment variables (for local development) - GROQ_API_KEY
-    3. .env file (for local development) - GROQ_API_KEY=your_key_here
-    
-    You can get an API key from: https://console.groq.com/
-    """
-    print(error_msg)
-    # Don't exit in Streamlit environment, just show error
-    if 'streamlit' not in sys.modules:
-        sys.exit(1)
-else:
-    print(f"[INFO] API Key Status: Found (Length: {len(GROQ_API_KEY)} characters)")
-    if GROQ_API_KEY.startswith("gsk_"):
-        print("[INFO] API Key format looks correct (starts with 'gsk_')")
-        # Test the API key
-        if test_api_key(GROQ_API_KEY):
-            print("[INFO] API Key is valid and working!")
-        else:
-            print("[WARN] API Key test failed - key may be invalid or expired")
+async def analyze_image_with_query_async(query, encoded_image, language="English", model="llama3.1-8b-instant",
+                                         reuse_similar=True):
+    """Async version of analyze_image_with_query using the shared async client"""
+    if not query or not encoded_image:
+        logging.error("Missing required parameters for analyze_image_with_query")
+        return "Error: Missing required parameters for image analysis."
+
+    cache_key = _image_cache_key(query, encoded_image, language, model)
+    cached = get_cache().get(cache_key)
+    if cached is not None:
+        return cached
+    similar = _similar_image_result(query, encoded_image, language, model) if reuse_similar else None
+    if similar is not None:
+        return similar
+    result = await _analyses.do_async(cache_key, _analyze_image_uncached_async, cache_key, query, language, model)
+    if reuse_similar:
+        _index_image(cache_key, query, encoded_image, language, model)
+    return result
+
+async def _analyze_image_uncached_async(cache_key, query, language, model):
+    client = get_async_client()
+    messages = _image_query_messages(query, language)
+
+    try:
+        response = await groq_call_async(
+            client.chat.completions.create,
+            messages=messages,
+            model=model,
+            max_tokens=800
+        )
+        return _remember(cache_key, _image_query_result(response, language))
+
+    except Exception as e:
+        logging.error(f"Vision analysis failed: {str(e)}")
+        if "model_not_found" in str(e):
+            return await analyze_text_query_async(query, language)
+        return f"Vision analysis failed: {str(e)}"
+
+def supports_multiple_images(model):
+    """Whether model takes several images in one chat request"""
+    return "vision" in model or model.startswith("meta-llama/llama-4")
+
+def _images_query_messages(query, language, encoded_images):
+    """Image analysis messages with every photo attached to the patient's message"""
+    messages = _image_query_messages(query, language, attached=True)
+    if len(encoded_images) == 1:
+        intro = "The patient attached a photo of the area.\n"
     else:
-        print("[WARN] API Key format may be incorrect (should start with 'gsk_')")
+        intro = f"The patient attached {len(encoded_images)} photos of the same area, numbered in order.\n"
+    messages[-1]["content"] = [{"type": "text", "text": intro + messages[-1]["content"]}] + [
+        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded}"}}
+        for encoded in encoded_images
+    ]
+    return messages
+
+def _images_cache_key(query, encoded_images, language, model):
+    digests = [hashlib.sha256(encoded.encode("utf-8")).hexdigest() for encoded in encoded_images]
+    return _cache_key("images", query, language, model, digests)
+
+def _combine_images(encoded_images, model):
+    """Return ("multi", photos to attach) for vision models, or ("single", encoded) for text-only ones"""
+    encoded_images = [encoded for encoded in encoded_images if encoded]
+    if not supports_multiple_images(model):
+        return "single", encoded_images[0] if len(encoded_images) == 1 else montage_images(encoded_images)
+    if len(encoded_images) > VISION_MAX_IMAGES:
+        encoded_images = [montage_images(encoded_images)]
+    return "multi", encoded_images
+
+def analyze_images_with_query(query, encoded_images, language="English", model="llama3.1-8b-instant",
+                              reuse_similar=True):
+    """Analyze several photos of the same problem in one model request.
+
+    Vision models get every photo attached to one message (tiled into a
+    montage when there are more than VISION_MAX_IMAGES); for other models
+    the photos are tiled into a montage and analyzed like a single image.
+    A request refused for its photos (400/422) is retried once with a single
+    montage; other API errors, such as rate limits and timeouts, are raised.
+    reuse_similar is passed on to analyze_image_with_query.
+    """
+    if not query or not encoded_images or not any(encoded_images):
+        logging.error("Missing required parameters for analyze_images_with_query")
+        return "Error: Missing required parameters for image analysis."
+    kind, payload = _combine_images(encoded_images, model)
+    if kind == "single":
+        return analyze_image_with_query(query, payload, language, model, reuse_similar)
+
+    cache_key = _images_cache_key(query, payload, language, model)
+    cached = get_cache().get(cache_key)
+    if cached is not None:
+        return cached
+    return _analyses.do(cache_key, _analyze_images_uncached, cache_key, query, payload, language, model)
+
+def _rejects_images(error):
+    """Whether a failed request was refused for its content (400/422), as when a model takes fewer images"""
+    return getattr(error, "status_code", None) in (400, 422)
+
+def _analyze_images_uncached(cache_key, query, encoded_images, language, model):
+    def request(images):
+        return groq_call(
+            get_client().chat.completions.create,
+            messages=_images_query_messages(query, language, images),
+            model=model,
+            max_tokens=800
+        )
+    try:
+        response = request(encoded_images)
+    except Exception as e:
+        # Rate limits and timeouts were already retried by the limiter; another call would only add load
+        if len(encoded_images) == 1 or not _rejects_images(e):
+            raise
+        logging.warning(f"Model refused {len(encoded_images)} images, sending one montage: {str(e)}")
+        response = request([montage_images(encoded_images)])
+    return _remember(cache_key, _image_query_result(response, language))
+
+async def analyze_images_with_query_async(query, encoded_images, language="English", model="llama3.1-8b-instant",
+                                          reuse_similar=True):
+    """Async version of analyze_images_with_query using the shared async client"""
+    if not query or not encoded_images or not any(encoded_images):
+        logging.error("Missing required parameters for analyze_images_with_query")
+        return "Error: Missing required parameters for image analysis."
+    kind, payload = _combine_images(encoded_images, model)
+    if kind == "single":
+        return await analyze_image_with_query_async(query, payload, language, model, reuse_similar)
+
+    cache_key = _images_cache_key(query, payload, language, model)
+    cached = get_cache().get(cache_key)
+    if cached is not None:
+        return cached
+    return await _analyses.do_async(cache_key, _analyze_images_uncached_async, cache_key, query, payload,
+                                    language, model)
+
+async def _analyze_images_uncached_async(cache_key, query, encoded_images, language, model):
+    async def request(images):
+        return await groq_call_async(
+            get_async_client().chat.completions.create,
+            messages=_images_query_messages(query, language, images),
+            model=model,
+            max_tokens=800
+        )
+    try:
+        response = await request(encoded_images)
+    except Exception as e:
+        if len(encoded_images) == 1 or not _rejects_images(e):
+            raise
+        logging.warning(f"Model refused {len(encoded_images)} images, sending one montage: {str(e)}")
+        response = await request([montage_images(encoded_images)])
+    return _remember(cache_key, _image_query_result(response, language))
 
 def analyze_image(image_path):
     """Analyze image using computer vision"""
     try:
         from image_analysis import analyze_image_colors
-        analysis = analyze_image_colors(image_path)
+        # Histogram mode is deterministic, so the same image always reads the same
+        analysis = analyze_image_colors(image_path, method="histogram")
         return f"Image analysis results: Dominant colors are {', '.join(analysis['dominant_colors'])}"
     except Exception as e:
         raise ValueError(f"Image analysis failed: {str(e)}")
 
-@lru_cache(maxsize=100)
-def analyze_text_query(query, language="English", model="llama-3.1-8b-instant", max_retries=3):
-    """Process text queries with GROQ API with caching and focused diagnosis"""
-    import logging
-    if not query or not isinstance(query, str):
-        logging.error("Invalid query parameter for analyze_text_query")
-        return "Error: Invalid query parameter."
-        
-    client = Groq(api_key=get_api_key())
-    
+def _text_query_messages(query, language):
+    """Build the chat messages for a text diagnosis, varying the wording"""
     # Language-specific prompts with varied response patterns - focused on concise diagnosis only
     language_prompts = {
         "English": [
@@ -493,50 +962,286 @@ def analyze_text_query(query, language="English", model="llama-3.1-8b-instant",
         {"role": "system", "content": system_prompt_with_language},
         {"role": "user", "content": user_query}
     ]
+    return messages
 
-    last_error = None
-    for attempt in range(max_retries):
-        try:
-            response = client.chat.completions.create(
-                messages=messages,
-                model=model,
-                max_tokens=800,
-                temperature=0.7  # Add some randomness to responses
-            )
-            
-            if not response.choices:
-                logging.error("Empty response from API in analyze_text_query")
-                return "Error: Empty response from text analysis."
-                
-            content = response.choices[0].message.content
-            print("MODEL RAW OUTPUT:", repr(content))
-            if not isinstance(content, str):
-                content = str(content)
-            if not content.strip():
-                logging.error("Empty content string from analyze_text_query")
-                return "Error: Empty content from text analysis."
-            
-            # Add some post-processing to ensure varied responses
-            diagnosis_variations = [
-                content,
-                f"MEDICAL ANALYSIS:\n{content}",
-                f"DIAGNOSTIC ASSESSMENT:\n{content}",
-                f"CLINICAL EVALUATION:\n{content}"
-            ]
-            
-            return random.choice(diagnosis_variations)
-            
-        except GroqError as e:
-            last_error = e
-            if attempt < max_retries - 1:
-                time.sleep(1 * (attempt + 1))  # Exponential backoff
+def _text_query_result(response):
+    """Validate the text analysis response and vary its heading"""
+    if not response.choices:
+        logging.error("Empty response from API in analyze_text_query")
+        return "Error: Empty response from text analysis."
+        
+    content = response.choices[0].message.content
+    print("MODEL RAW OUTPUT:", repr(content))
+    if not isinstance(content, str):
+        content = str(content)
+    if not content.strip():
+        logging.error("Empty content string from analyze_text_query")
+        return "Error: Empty content from text analysis."
+    
+    # Add some post-processing to ensure varied responses
+    return _diagnosis_heading() + content
+
+def _diagnosis_heading():
+    """Pick one of the headings used to vary diagnosis responses"""
+    headings = [
+        "",
+        "MEDICAL ANALYSIS:\n",
+        "DIAGNOSTIC ASSESSMENT:\n",
+        "CLINICAL EVALUATION:\n"
+    ]
+    return random.choice(headings)
+
+def analyze_text_query(query, language="English", model="llama-3.1-8b-instant", max_retries=3):
+    """Process text queries with GROQ API with caching and focused diagnosis"""
+    import logging
+    if not query or not isinstance(query, str):
+        logging.error("Invalid query parameter for analyze_text_query")
+        return "Error: Invalid query parameter."
+
+    cache_key = _cache_key("text", query, language, model)
+    cached = get_cache().get(cache_key)
+    if cached is not None:
+        return cached
+    return _analyses.do(cache_key, _analyze_text_uncached, cache_key, query, language, model, max_retries)
+
+def _analyze_text_uncached(cache_key, query, language, model, max_retries):
+    client = get_client()
+    
+    messages = _text_query_messages(query, language)
+
+    try:
+        # Retries (honouring Retry-After) are handled by the shared rate limiter
+        response = groq_call(
+            client.chat.completions.create,
+            messages=messages,
+            model=model,
+            max_tokens=800,
+            temperature=0.7,  # Add some randomness to responses
+            max_retries=max_retries
+        )
+        return _remember(cache_key, _text_query_result(response))
+        
+    except _groq_error() as e:
+        logging.error(f"API request failed after retries: {str(e)}")
+        return f"Text analysis failed: {str(e)}"
+        
+    except Exception as e:
+        logging.error(f"Analysis failed: {str(e)}")
+        return f"Text analysis failed: {str(e)}"
+
+def stream_text_query(query, language="English", model="llama-3.1-8b-instant", max_retries=3):
+    """Streaming variant of analyze_text_query: yields the diagnosis in chunks as the model produces them"""
+    if not query or not isinstance(query, str):
+        logging.error("Invalid query parameter for stream_text_query")
+        yield "Error: Invalid query parameter."
+        return
+
+    cache_key = _cache_key("text", query, language, model)
+    cached = get_cache().get(cache_key)
+    if cached is not None:
+        yield cached
+        return
+
+    client = get_client()
+    messages = _text_query_messages(query, language)
+
+    # Retry only while opening the stream; once text has been shown it cannot be taken back
+    try:
+        stream = groq_call(
+            client.chat.completions.create,
+            messages=messages,
+            model=model,
+            max_tokens=800,
+            temperature=0.7,
+            stream=True,
+            max_retries=max_retries
+        )
+
+    except _groq_error() as e:
+        logging.error(f"API request failed after retries: {str(e)}")
+        yield f"Text analysis failed: {str(e)}"
+        return
+
+    except Exception as e:
+        logging.error(f"Analysis failed: {str(e)}")
+        yield f"Text analysis failed: {str(e)}"
+        return
+
+    heading = _diagnosis_heading()
+    received = []
+    try:
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            text = chunk.choices[0].delta.content
+            if not text:
                 continue
-            logging.error(f"API request failed after {max_retries} attempts: {str(e)}")
-            return f"Text analysis failed: {str(e)}"
-            
-        except Exception as e:
-            logging.error(f"Analysis failed: {str(e)}")
-            return f"Text analysis failed: {str(e)}"
+            if not received:
+                text = heading + text
+            received.append(text)
+            yield text
+    except Exception as e:
+        logging.error(f"Streaming analysis interrupted: {str(e)}")
+        yield f"\n\nText analysis interrupted: {str(e)}"
+        return
+
+    if not received:
+        logging.error("Empty content string from stream_text_query")
+        yield "Error: Empty content from text analysis."
+        return
+    _remember(cache_key, "".join(received))
+
+async def analyze_text_query_async(query, language="English", model="llama-3.1-8b-instant", max_retries=3):
+    """Async version of analyze_text_query using the shared async client"""
+    if not query or not isinstance(query, str):
+        logging.error("Invalid query parameter for analyze_text_query")
+        return "Error: Invalid query parameter."
+
+    cache_key = _cache_key("text", query, language, model)
+    cached = get_cache().get(cache_key)
+    if cached is not None:
+        return cached
+    return await _analyses.do_async(cache_key, _analyze_text_uncached_async, cache_key, query, language, model, max_retries)
+
+async def _analyze_text_uncached_async(cache_key, query, language, model, max_retries):
+    client = get_async_client()
+    messages = _text_query_messages(query, language)
+
+    try:
+        response = await groq_call_async(
+            client.chat.completions.create,
+            messages=messages,
+            model=model,
+            max_tokens=800,
+            temperature=0.7,
+            max_retries=max_retries
+        )
+        return _remember(cache_key, _text_query_result(response))
+
+    except _groq_error() as e:
+        logging.error(f"API request failed after retries: {str(e)}")
+        return f"Text analysis failed: {str(e)}"
+
+    except Exception as e:
+        logging.error(f"Analysis failed: {str(e)}")
+        return f"Text analysis failed: {str(e)}"
+
+def _structured_messages(symptoms, duration_days, language, encoded_image=None):
+    """Build the JSON-mode messages asking for diagnosis, medications and recommendations together"""
+    language_instructions = {
+        "English": "Respond in English only.",
+        "Hindi": "केवल हिंदी में उत्तर दें।",
+        "Marathi": "केवळ मराठीत उत्तर द्या।"
+    }
+    system_prompt = (
+        "You are a medical specialist. Assess the patient's report and reply with a single JSON object "
+        "with exactly these keys: "
+        '"diagnosis" (a concise diagnosis naming the most likely condition and key symptoms), '
+        '"medications" (a list of 2-3 strings, each: medication name, dosage, frequency, duration and special instructions), '
+        '"recommendations" (a list of short home care steps, lifestyle changes and when to seek urgent care). '
+        "Write the values in the requested language; keep the keys in English. "
+        f"{language_instructions.get(language, 'Respond in English only.')}"
+    )
+    report = [f"Symptoms: {symptoms}"]
+    if duration_days:
+        report.append(f"Duration (days): {duration_days}")
+    content = "\n".join(report)
+    if encoded_image:
+        report.append("The patient has also attached a photo of the affected area; examine it together with their description.")
+        content = [
+            {"type": "text", "text": "\n".join(report)},
+            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}"}},
+        ]
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": content}
+    ]
+
+def _as_lines(value):
+    """Normalize a JSON list (or newline-separated string) into clean text lines"""
+    if isinstance(value, str):
+        value = value.splitlines()
+    lines = []
+    for item in value or []:
+        if isinstance(item, dict):
+            item = ", ".join(str(v) for v in item.values() if v)
+        item = str(item).strip().lstrip("-•* ").strip()
+        if item:
+            lines.append(item)
+    return lines
+
+def _structured_payload(cache_key, messages, model, max_retries):
+    """Run the JSON-mode request; return the JSON text, or None if it failed"""
+    client = get_client()
+    try:
+        response = groq_call(
+            client.chat.completions.create,
+            messages=messages,
+            model=model,
+            max_tokens=800,
+            temperature=0.3,
+            response_format={"type": "json_object"},
+            max_retries=max_retries
+        )
+        payload = response.choices[0].message.content
+        if not isinstance(json.loads(payload), dict):
+            raise ValueError("expected a JSON object")
+    except _groq_error() as e:
+        logging.error(f"Structured diagnosis failed after retries: {str(e)}")
+        return None
+    except (ValueError, TypeError, IndexError) as e:
+        logging.error(f"Structured diagnosis returned invalid JSON: {str(e)}")
+        return None
+    get_cache().set(cache_key, payload)
+    return payload
+
+def get_diagnosis_and_prescription(symptoms, duration_days=None, language="English", audio_file=None,
+                                   image_file=None, encoded_image=None, model="llama-3.1-8b-instant", max_retries=3,
+                                   vision_model=VISION_MODEL):
+    """Diagnosis, prescription and recommendations from one JSON-mode request.
+
+    A photo (image_file or encoded_image) is attached to the request, which
+    then goes to vision_model unless model can already see images.
+    Returns a (diagnosis, prescription, recommendations) tuple of strings. The
+    prescription uses the same template as generate_prescription.
+    """
+    if audio_file:
+        from voice_of_the_patient import transcribe_with_groq
+        transcript = transcribe_with_groq("whisper-large-v3", audio_file)
+        if transcript:
+            symptoms = f"{transcript} ({symptoms})" if symptoms else transcript
+    if image_file and not encoded_image:
+        encoded_image = encode_image(image_file)
+    if not symptoms or not isinstance(symptoms, str):
+        raise ValueError("Symptoms must be a non-empty string")
+
+    if encoded_image and not supports_multiple_images(model):
+        model = vision_model
+    payload_digest = hashlib.sha256(encoded_image.encode("utf-8")).hexdigest() if encoded_image else None
+    cache_key = _cache_key("structured", symptoms, language, model, duration_days, payload_digest)
+    payload = get_cache().get(cache_key)
+
+    if payload is None:
+        messages = _structured_messages(symptoms, duration_days, language, encoded_image)
+        payload = _analyses.do(cache_key, _structured_payload, cache_key, messages, model, max_retries)
+
+    def plain_diagnosis():
+        if encoded_image:
+            return analyze_images_with_query(symptoms, [encoded_image], language, model)
+        return analyze_text_query(symptoms, language)
+
+    if payload is None:
+        # Fall back to the two-call path rather than failing the consultation
+        diagnosis = plain_diagnosis()
+        return diagnosis, generate_prescription(diagnosis, language), ""
+
+    data = json.loads(payload)
+    diagnosis = str(data.get("diagnosis") or "").strip()
+    if not diagnosis:
+        diagnosis = plain_diagnosis()
+    medications = _as_lines(data.get("medications")) or _parse_medications("", language)
+    recommendations = "\n".join(f"- {item}" for item in _as_lines(data.get("recommendations")))
+    return diagnosis, _format_prescription(diagnosis, medications, language), recommendations
 
 if __name__ == "__main__":
     os.system("python D:\\EDIT KAREGE\\ai-doctor-2.0-voice-and-vision\\ai-doctor-2.0-voice-and-vision\\ai_doctor_fully_fixed.py")
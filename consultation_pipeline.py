@@ -0,0 +1,120 @@
+# Per-consultation stage graph: each step starts as soon as its inputs are ready
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# One bounded pool shared by every consultation in the process
+PIPELINE_MAX_WORKERS = int(os.environ.get("PIPELINE_MAX_WORKERS", "16"))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Shared thread pool that runs pipeline stages"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=PIPELINE_MAX_WORKERS,
+                thread_name_prefix="consultation",
+            )
+        return _executor
+
+
+class StageFailed(RuntimeError):
+    """A stage could not run because it, or one of its inputs, failed"""
+
+
+class StageGraph:
+    """Dependency graph of consultation stages.
+
+    Each stage is a callable that receives the results of its dependencies as
+    keyword arguments. run() submits every stage whose inputs are ready to the
+    shared pool, so independent stages overlap and the consultation only waits
+    for its critical path.
+    """
+
+    def __init__(self, executor=None):
+        self._executor = executor
+        self._stages = {}
+        self.errors = {}
+        self.timings = {}
+
+    def add(self, name, func, deps=(), timeout=None):
+        """Register a stage; deps name earlier stages or run() inputs"""
+        if name in self._stages:
+            raise ValueError(f"Stage '{name}' already exists")
+        self._stages[name] = (func, tuple(deps), timeout)
+        return self
+
+    def run(self, **inputs):
+        """Run the graph and return {stage name: result} for every stage that succeeded.
+
+        Failed, timed-out and skipped stages are left out of the result and
+        their exceptions are recorded in self.errors.
+        """
+        executor = self._executor or get_executor()
+        results = dict(inputs)
+        pending = dict(self._stages)
+        running = {}
+        self.errors = {}
+        self.timings = {}
+
+        for name, (_, deps, _) in pending.items():
+            unknown = [dep for dep in deps if dep not in pending and dep not in inputs]
+            if unknown:
+                raise ValueError(f"Stage '{name}' depends on unknown stage(s): {', '.join(unknown)}")
+
+        while pending or running:
+            # Start every stage whose dependencies are resolved
+            for name, (func, deps, timeout) in list(pending.items()):
+                failed = [dep for dep in deps if dep in self.errors]
+                if failed:
+                    del pending[name]
+                    self.errors[name] = StageFailed(f"Skipped: input '{failed[0]}' failed")
+                    continue
+                if all(dep in results for dep in deps):
+                    del pending[name]
+                    kwargs = {dep: results[dep] for dep in deps}
+                    started = time.monotonic()
+                    deadline = started + timeout if timeout else None
+                    running[executor.submit(func, **kwargs)] = (name, started, deadline)
+
+            if not running:
+                if pending:
+                    # Remaining stages can never become ready
+                    for name in pending:
+                        self.errors[name] = StageFailed("Skipped: unresolved dependencies")
+                break
+
+            deadlines = [deadline for _, _, deadline in running.values() if deadline]
+            wait_for = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+            done, _ = concurrent.futures.wait(
+                running, timeout=wait_for, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+
+            for future in done:
+                name, started, _ = running.pop(future)
+                self.timings[name] = time.monotonic() - started
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    logger.error(f"Stage '{name}' failed: {str(e)}")
+                    self.errors[name] = e
+
+            now = time.monotonic()
+            for future, (name, started, deadline) in list(running.items()):
+                if deadline and now >= deadline:
+                    # The worker thread cannot be interrupted; stop waiting for it
+                    future.cancel()
+                    del running[future]
+                    self.timings[name] = now - started
+                    logger.error(f"Stage '{name}' timed out")
+                    self.errors[name] = TimeoutError(f"Stage '{name}' timed out")
+
+        return {name: value for name, value in results.items() if name in self._stages}
@@ -1,6 +1,5 @@
 from brain_of_the_doctor import analyze_image, analyze_text_query
-from image_analysis import detect_edges
-import cv2
+from image_analysis import detect_edges, save_edges
 
 def run_demo(image_path):
     print("\n=== IMAGE ANALYSIS DEMO ===")
@@ -18,8 +17,8 @@ def run_demo(image_path):
     # 3. Edge Detection
     print("\n[3] Performing edge detection...")
     edges = detect_edges(image_path)
-    cv2.imwrite('edges.jpg', edges)
-    print("Edge detection complete - saved to edges.jpg")
+    save_edges(edges, 'edges.png')  # 1-bit PNG: lossless and far smaller than JPEG
+    print("Edge detection complete - saved to edges.png")
     
     print("\n=== DEMO COMPLETE ===")
 
@@ -0,0 +1,178 @@
+# Persistent diagnosis cache shared by every worker process (SQLite in WAL mode)
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DIAGNOSIS_CACHE_PATH = os.environ.get("DIAGNOSIS_CACHE_PATH", "diagnosis_cache.sqlite3")
+DIAGNOSIS_CACHE_TTL = float(os.environ.get("DIAGNOSIS_CACHE_TTL", str(7 * 24 * 3600)))
+DIAGNOSIS_CACHE_MAX_BYTES = int(os.environ.get("DIAGNOSIS_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# A hit only rewrites an entry's access time if the stored one is older than this (seconds)
+ACCESS_TIME_RESOLUTION = 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at);
+CREATE INDEX IF NOT EXISTS entries_created_at ON entries (created_at);
+-- Running total of entries.size, kept by triggers so no write has to scan the table
+CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL);
+INSERT INTO totals (id, bytes)
+    SELECT 0, (SELECT COALESCE(SUM(size), 0) FROM entries) WHERE NOT EXISTS (SELECT 1 FROM totals);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries
+    BEGIN UPDATE totals SET bytes = bytes + NEW.size WHERE id = 0; END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries
+    BEGIN UPDATE totals SET bytes = bytes - OLD.size WHERE id = 0; END;
+CREATE TRIGGER IF NOT EXISTS entries_resize AFTER UPDATE OF size ON entries
+    BEGIN UPDATE totals SET bytes = bytes + NEW.size - OLD.size WHERE id = 0; END;
+"""
+
+
+def normalize_query(query):
+    """Collapse whitespace and case so trivially different complaints share an entry"""
+    return " ".join(str(query).split()).casefold()
+
+
+def make_key(*parts):
+    """Stable digest of the parts that identify a cached result"""
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DiagnosisCache:
+    """Key/value store with a TTL and a total-bytes bound, evicting least recently used"""
+
+    def __init__(self, path=DIAGNOSIS_CACHE_PATH, ttl=DIAGNOSIS_CACHE_TTL, max_bytes=DIAGNOSIS_CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "sets": 0, "evictions": 0, "errors": 0}
+
+    def _connection(self):
+        # sqlite3 connections must not be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._stats[name] += n
+
+    def get(self, key):
+        """Return the cached value for key, or None on a miss or expiry"""
+        now = time.time()
+        try:
+            conn = self._connection()
+            row = conn.execute("SELECT value, created_at, accessed_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self._count("misses")
+                return None
+            # LRU order only needs coarse access times; skipping most updates keeps hits read-only
+            if now - row[2] >= ACCESS_TIME_RESOLUTION:
+                conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+        except sqlite3.Error as e:
+            logger.warning(f"Diagnosis cache read failed: {str(e)}")
+            self._count("errors")
+            self._count("misses")
+            return None
+        self._count("hits")
+        return row[0]
+
+    def set(self, key, value):
+        """Store value under key, then evict until the cache fits max_bytes"""
+        now = time.time()
+        size = len(key) + len(value.encode("utf-8"))
+        try:
+            conn = self._connection()
+            # An upsert (not INSERT OR REPLACE) so the size triggers see replaced entries
+            conn.execute(
+                "INSERT INTO entries (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value, size = excluded.size, "
+                "created_at = excluded.created_at, accessed_at = excluded.accessed_at",
+                (key, value, size, now, now),
+            )
+            self._count("sets")
+            self._evict(conn, now)
+        except sqlite3.Error as e:
+            logger.warning(f"Diagnosis cache write failed: {str(e)}")
+            self._count("errors")
+
+    def _evict(self, conn, now):
+        expired = conn.execute("DELETE FROM entries WHERE created_at < ?", (now - self.ttl,)).rowcount
+        total = conn.execute("SELECT bytes FROM totals WHERE id = 0").fetchone()[0]
+        excess = total - self.max_bytes
+        victims = []
+        if excess > 0:
+            for key, size in conn.execute("SELECT key, size FROM entries ORDER BY accessed_at"):
+                victims.append((key,))
+                excess -= size
+                if excess <= 0:
+                    break
+            conn.executemany("DELETE FROM entries WHERE key = ?", victims)
+        if expired or victims:
+            self._count("evictions", expired + len(victims))
+
+    def clear(self):
+        try:
+            self._connection().execute("DELETE FROM entries")
+        except sqlite3.Error as e:
+            logger.warning(f"Diagnosis cache clear failed: {str(e)}")
+
+    def stats(self):
+        """Hit/miss counters for this process plus the shared cache's size"""
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        try:
+            entries, total = self._connection().execute(
+                "SELECT (SELECT COUNT(*) FROM entries), bytes FROM totals WHERE id = 0"
+            ).fetchone()
+            stats["entries"] = entries
+            stats["bytes"] = total
+        except sqlite3.Error:
+            pass
+        return stats
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def get_cache():
+    """Process-wide cache instance, opened on first use"""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = DiagnosisCache()
+        return _default_cache
+
+
+def set_cache(cache):
+    """Replace the process-wide cache (e.g. with a temporary one in tests)"""
+    global _default_cache
+    with _default_lock:
+        _default_cache = cache
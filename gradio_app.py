@@ -2,11 +2,15 @@
 import os
 import gradio as gr
 import numpy as np
-from pydub import AudioSegment
 
-from brain_of_the_doctor import encode_image, analyze_image_with_query
+from brain_of_the_doctor import encode_images, analyze_images_with_query, health_check
+from video_intake import encode_video_frames
 from voice_of_the_patient import record_audio, transcribe_with_groq
 from voice_of_the_doctor import text_to_speech_with_gtts, text_to_speech_with_elevenlabs
+from audio_format import validate_audio
+from tts_cache import speech_key
+from phrase_bank import warm_up as warm_up_phrases
+warm_up_phrases()  # pre-render disclaimers and prescription headings when PHRASE_BANK_WARM_UP=1
 from custom_avatar import SpeakingAvatar
 
 system_prompt="""You are a professional doctor providing medical advice. 
@@ -33,9 +37,24 @@ def check_browser_permissions():
         print(f"Microphone check failed: {str(e)}")
         return False
 
-import concurrent.futures
+def api_key_status():
+    """One-line Groq API key status for the page header (checked at most every few minutes)"""
+    health = health_check()
+    if health["api_key_valid"]:
+        return f"✅ {health['message']}"
+    if health["api_key_found"]:
+        return f"⚠️ {health['message']}"
+    return f"❌ {health['message']}"
 
-def process_inputs(input_data, image_filepath, language="English", voice_pack="default", progress=gr.Progress()):
+from consultation_pipeline import StageGraph
+
+# Seconds any single consultation stage may take
+STAGE_TIMEOUT = 90
+
+# gr.Audio plays MP3 in every browser, so responses stay in the engines' native format
+AUDIO_FORMAT = "mp3"
+
+def process_inputs(input_data, image_filepaths, language="English", voice_pack="default", progress=gr.Progress()):
     # Handle both audio and text input cases
     if isinstance(input_data, dict):  # Audio input case from Gradio
         # Extract the actual file path from Gradio's audio dict
@@ -65,105 +84,119 @@ def process_inputs(input_data, image_filepath, language="English", voice_pack="d
             Please check your microphone settings and try again.
             """)
 
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            # Handle input based on type
-            if audio_filepath:
-                # Submit speech-to-text task
-                stt_future = executor.submit(
-                    transcribe_with_groq,
-                    GROQ_API_KEY=os.environ.get("GROQ_API_KEY"),
-                    audio_filepath=audio_filepath,
-                    stt_model="whisper-large-v3"
-                )
-            else:
-                # Use text input directly
-                stt_future = executor.submit(lambda: text_input)
-            
-            # Submit image analysis task if image provided
-            image_future = None
-            if image_filepath and os.path.exists(image_filepath):
-                encoded_image = encode_image(image_filepath)
-                image_future = executor.submit(
-                    analyze_image_with_query,
+        # Each stage starts as soon as its inputs are ready: the voice response and the
+        # avatar both only need the doctor's response, so they run side by side
+        graph = StageGraph()
+        if audio_filepath:
+            # Speech-to-text stage
+            graph.add("speech_to_text", lambda: transcribe_with_groq(
+                GROQ_API_KEY=os.environ.get("GROQ_API_KEY"),
+                audio_filepath=audio_filepath,
+                stt_model="whisper-large-v3"
+            ), timeout=STAGE_TIMEOUT)
+        else:
+            # Use text input directly
+            graph.add("speech_to_text", lambda: text_input)
+
+        def analyze_image():
+            existing = [path for path in (image_filepaths or []) if os.path.exists(path)]
+            if not existing:
+                return "No image provided for analysis"
+            try:
+                # Every photo goes into the same request
+                encoded_images = encode_images(existing)
+                response = analyze_images_with_query(
                     query=system_prompt.format(language=language),
-                    encoded_image=encoded_image,
-                    model="llama-3.2-11b-vision-preview"
+                    encoded_images=encoded_images,
+                    model="llama-3.2-11b-vision-preview",
+                    # The query is the same fixed prompt for every patient: only reuse exact photos
+                    reuse_similar=False
                 )
-            
-            # Get speech-to-text result
-            progress(0.4, desc="Processing speech...")
-            try:
-                speech_to_text_output = stt_future.result()
-                if not speech_to_text_output.strip():
-                    raise ValueError("Speech recognition returned empty result")
+                if not response.strip():
+                    response = "Received empty analysis response"
+                return response
             except Exception as e:
-                raise ValueError(f"Speech recognition failed: {str(e)}")
-
-            # Get image analysis result if submitted
-            doctor_response = "No image provided for analysis"
-            if image_future:
-                progress(0.6, desc="Analyzing image...")
-                try:
-                    doctor_response = image_future.result()
-                    if not doctor_response.strip():
-                        doctor_response = "Received empty analysis response"
-                except Exception as e:
-                    doctor_response = f"⚠️ Image analysis error: {str(e)}"
-
-            # Generate voice response
-            progress(0.8, desc="Generating response...")
+                return f"⚠️ Image analysis error: {str(e)}"
+
+        def generate_voice(doctor_response):
+            # Generate unique filename for each response
+            output_file = f"response_{speech_key(doctor_response, language, voice_pack)[:16]}.{AUDIO_FORMAT}"
+            
             try:
-                # Generate unique filename for each response
-                output_file = f"response_{hash(doctor_response)}.wav"
-                
-                try:
-                    if voice_pack == "Human Male":
-                        text_to_speech_with_gtts(
-                            input_text=doctor_response,
-                            output_filepath=output_file,
-                            language=language,
-                            voice_pack="human_male"
-                        )
-                    else:  # AI Voice options
-                        voice_map = {
-                            "Professional (AI)": "professional",
-                            "Friendly (AI)": "friendly",
-                            "Serious (AI)": "serious",
-                            "Compassionate (AI)": "compassionate"
-                        }
-                        text_to_speech_with_elevenlabs(
-                            input_text=doctor_response,
-                            output_filepath=output_file,
-                            voice=voice_map.get(voice_pack, "professional")
-                        )
-                    
-                    if not os.path.exists(output_file):
-                        raise ValueError("Audio file was not generated")
-                        
-                    # Ensure file is readable
-                    AudioSegment.from_wav(output_file)
-                except Exception as e:
-                    print(f"Voice generation failed, falling back to gTTS: {str(e)}")
+                if voice_pack == "Human Male":
                     text_to_speech_with_gtts(
                         input_text=doctor_response,
                         output_filepath=output_file,
-                        language=language
+                        language=language,
+                        voice_pack="human_male",
+                        output_format=AUDIO_FORMAT
                     )
+                else:  # AI Voice options
+                    voice_map = {
+                        "Professional (AI)": "professional",
+                        "Friendly (AI)": "friendly",
+                        "Serious (AI)": "serious",
+                        "Compassionate (AI)": "compassionate"
+                    }
+                    output_file = text_to_speech_with_elevenlabs(
+                        input_text=doctor_response,
+                        output_filepath=output_file,
+                        voice=voice_map.get(voice_pack, "professional"),
+                        output_format=AUDIO_FORMAT
+                    )
+                
+                if not os.path.exists(output_file):
+                    raise ValueError("Audio file was not generated")
+                    
+                # Ensure file is playable: the header is enough, no need to decode it
+                validate_audio(output_file)
             except Exception as e:
-                print(f"Voice generation error: {str(e)}")
-                raise
+                print(f"Voice generation failed, falling back to gTTS: {str(e)}")
+                text_to_speech_with_gtts(
+                    input_text=doctor_response,
+                    output_filepath=output_file,
+                    language=language,
+                    output_format=AUDIO_FORMAT
+                )
+            return output_file
 
-            # Generate avatar
-            try:
-                avatar = SpeakingAvatar()
-                speaking_avatar = avatar.get_avatar(doctor_response)
-                if not isinstance(speaking_avatar, np.ndarray):
-                    raise ValueError("Avatar image not generated properly")
-                return speaking_avatar, speech_to_text_output, doctor_response, output_file
-            except Exception as e:
-                print(f"Avatar error: {str(e)}")
-                default_img = np.array(Image.new('RGB', (300, 300), (255,255,255)))
-                return default_img, speech_to_text_output, doctor_response, output_file
+        def generate_avatar(doctor_response):
+            avatar = SpeakingAvatar()
+            speaking_avatar = avatar.get_avatar(doctor_response)
+            if not isinstance(speaking_avatar, np.ndarray):
+                raise ValueError("Avatar image not generated properly")
+            return speaking_avatar
+
+        graph.add("doctor_response", analyze_image, timeout=STAGE_TIMEOUT)
+        graph.add("voice", generate_voice, deps=["doctor_response"], timeout=STAGE_TIMEOUT)
+        graph.add("avatar", generate_avatar, deps=["doctor_response"], timeout=STAGE_TIMEOUT)
+
+        progress(0.4, desc="Processing speech...")
+        results = graph.run()
+
+        # Get speech-to-text result
+        try:
+            if "speech_to_text" in graph.errors:
+                raise graph.errors["speech_to_text"]
+            speech_to_text_output = results["speech_to_text"]
+            if not speech_to_text_output.strip():
+                raise ValueError("Speech recognition returned empty result")
+        except Exception as e:
+            raise ValueError(f"Speech recognition failed: {str(e)}")
+
+        progress(0.8, desc="Generating response...")
+        doctor_response = results["doctor_response"]
+        if "voice" in graph.errors:
+            print(f"Voice generation error: {str(graph.errors['voice'])}")
+            raise graph.errors["voice"]
+        output_file = results["voice"]
+
+        # Generate avatar
+        if "avatar" in graph.errors:
+            print(f"Avatar error: {str(graph.errors['avatar'])}")
+            default_img = np.array(Image.new('RGB', (300, 300), (255,255,255)))
+            return default_img, speech_to_text_output, doctor_response, output_file
+        return results["avatar"], speech_to_text_output, doctor_response, output_file
 
     except Exception as e:
         error_msg = f"""
@@ -282,6 +315,7 @@ with gr.Blocks(
         neutral_hue="gray"
     )
 ) as app:
+    api_status = gr.Markdown()
     with gr.Tabs():
         with gr.TabItem("Voice Input"):
             audio_input = gr.Audio(
@@ -297,7 +331,13 @@ with gr.Blocks(
                 lines=3
             )
     
-    image_input = gr.Image(type="filepath", label="Upload Medical Image")
+    image_input = gr.File(
+        file_count="multiple",
+        file_types=["image"],
+        type="filepath",
+        label="Upload Medical Images (several photos of the same area are analyzed together)"
+    )
+    video_input = gr.Video(label="Or Upload a Short Video", sources=["upload"])
     language = gr.Dropdown(
         choices=["English", "Hindi", "Marathi"],
         value="English",
@@ -324,26 +364,31 @@ with gr.Blocks(
     with gr.Row():
         prescription_output = gr.Textbox(label="Prescription", visible=False)
 
-    def process_combined_inputs(audio, text, image, lang, voice, progress=gr.Progress()):
+    def process_combined_inputs(audio, text, image, video, lang, voice, progress=gr.Progress()):
         progress(0.1, desc="Initializing analysis...")
         
         try:
             # Handle image input completely independently
-            if image is not None:
-                progress(0.3, desc="Encoding image...")
-                encoded_image = encode_image(image)
+            if image or video:
+                progress(0.3, desc="Encoding images...")
+                encoded_images = encode_images(image or [])
+                if video:
+                    # Only a handful of keyframes are decoded, never the whole clip
+                    encoded_images += encode_video_frames(video)
                 
-                progress(0.5, desc="Analyzing medical image...")
-                doctor_response = analyze_image_with_query(
+                progress(0.5, desc="Analyzing medical images...")
+                doctor_response = analyze_images_with_query(
                     query=system_prompt.format(language=lang),
-                    encoded_image=encoded_image,
-                    model="llama-3.2-11b-vision-preview"
+                    encoded_images=encoded_images,
+                    model="llama-3.2-11b-vision-preview",
+                    # The query is the same fixed prompt for every patient: only reuse exact photos
+                    reuse_similar=False
                 )
                 stt_output = "Automatic image analysis"
                 
                 # Generate response for image
                 progress(0.7, desc="Generating response...")
-                output_file = f"response_{hash(doctor_response)}.wav"
+                output_file = f"response_{speech_key(doctor_response, lang, 'default')[:16]}.{AUDIO_FORMAT}"
                 
                 # Fix for Hindi description
                 if lang == "Hindi":
@@ -377,8 +422,10 @@ with gr.Blocks(
         
     submit_btn.click(
         fn=process_combined_inputs,
-        inputs=[audio_input, text_input, image_input, language, voice_pack],
+        inputs=[audio_input, text_input, image_input, video_input, language, voice_pack],
         outputs=[avatar_output, stt_output, response_output, audio_output]
     )
+    # Checked when the page opens rather than at import, so startup never waits on the API
+    app.load(fn=api_key_status, outputs=api_status)
 
 app.launch(debug=True, share=True)
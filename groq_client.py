@@ -0,0 +1,189 @@
+# Shared Groq client registry
+import logging
+import os
+import threading
+import weakref
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# groq and httpx are imported inside the builders below: they take a few
+# hundred milliseconds to import and most importers never make a call.
+
+logger = logging.getLogger(__name__)
+
+# Connection settings (override through environment variables)
+GROQ_TIMEOUT = float(os.environ.get("GROQ_TIMEOUT", "60"))
+GROQ_CONNECT_TIMEOUT = float(os.environ.get("GROQ_CONNECT_TIMEOUT", "5"))
+GROQ_MAX_CONNECTIONS = int(os.environ.get("GROQ_MAX_CONNECTIONS", "50"))
+GROQ_MAX_KEEPALIVE = int(os.environ.get("GROQ_MAX_KEEPALIVE", "20"))
+GROQ_KEEPALIVE_EXPIRY = float(os.environ.get("GROQ_KEEPALIVE_EXPIRY", "120"))
+
+_lock = threading.Lock()
+_clients = {}
+# Async clients are bound to the event loop that created them
+_async_clients = weakref.WeakKeyDictionary()
+_api_key = None
+_stats = {
+    "clients_created": 0,
+    "client_reuses": 0,
+    "requests": 0,
+    "connections_opened": 0,
+}
+
+
+def get_api_key():
+    """Get API key from Streamlit secrets or environment variables"""
+    try:
+        import streamlit as st
+        return st.secrets["GROQ_API_KEY"]
+    except Exception:
+        return os.environ.get("GROQ_API_KEY")
+
+
+def resolve_api_key():
+    """Return the process-wide API key, looking it up only once"""
+    global _api_key
+    if _api_key is None:
+        _api_key = get_api_key()
+        if not _api_key:
+            from replay_backend import REPLAY_API_KEY, backend_mode
+            if backend_mode() == "replay":
+                # Cassettes need no credentials
+                _api_key = REPLAY_API_KEY
+    return _api_key
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+
+def _trace(event_name, info):
+    """httpcore trace hook: count TCP connections actually opened"""
+    if event_name == "connection.connect_tcp.complete":
+        _count("connections_opened")
+
+
+def _on_request(request):
+    _count("requests")
+    request.extensions["trace"] = _trace
+
+
+async def _trace_async(event_name, info):
+    _trace(event_name, info)
+
+
+async def _on_request_async(request):
+    _count("requests")
+    request.extensions["trace"] = _trace_async
+
+
+def _pool_limits():
+    import httpx
+    return httpx.Limits(
+        max_connections=GROQ_MAX_CONNECTIONS,
+        max_keepalive_connections=GROQ_MAX_KEEPALIVE,
+        keepalive_expiry=GROQ_KEEPALIVE_EXPIRY,
+    )
+
+
+def _build_http_client():
+    """Keep-alive HTTP pool shared by every call made through one client"""
+    import httpx
+    from replay_backend import http_transport
+    return httpx.Client(
+        timeout=httpx.Timeout(GROQ_TIMEOUT, connect=GROQ_CONNECT_TIMEOUT),
+        limits=_pool_limits(),
+        # None in live mode; a record/replay transport otherwise (see replay_backend)
+        transport=http_transport(_pool_limits()),
+        event_hooks={"request": [_on_request]},
+    )
+
+
+def _build_async_http_client():
+    import httpx
+    from replay_backend import async_http_transport
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(GROQ_TIMEOUT, connect=GROQ_CONNECT_TIMEOUT),
+        limits=_pool_limits(),
+        transport=async_http_transport(_pool_limits()),
+        event_hooks={"request": [_on_request_async]},
+    )
+
+
+def get_client(api_key=None):
+    """Return the pooled Groq client for an API key, creating it on first use"""
+    key = api_key or resolve_api_key()
+    with _lock:
+        client = _clients.get(key)
+        if client is not None:
+            _stats["client_reuses"] += 1
+            return client
+        from groq import Groq
+        # Retries are scheduled by rate_limiter so they respect the shared quota
+        client = Groq(api_key=key, http_client=_build_http_client(), max_retries=0)
+        _clients[key] = client
+        _stats["clients_created"] += 1
+        logger.info("Created pooled Groq client")
+        return client
+
+
+def get_async_client(api_key=None):
+    """Return the pooled AsyncGroq client for an API key on the running event loop"""
+    import asyncio
+    key = api_key or resolve_api_key()
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get(key)
+        if client is not None:
+            _stats["client_reuses"] += 1
+            return client
+        from groq import AsyncGroq
+        client = AsyncGroq(api_key=key, http_client=_build_async_http_client(), max_retries=0)
+        clients[key] = client
+        _stats["clients_created"] += 1
+        logger.info("Created pooled AsyncGroq client")
+        return client
+
+
+def set_client(client, api_key=None):
+    """Install a client (e.g. a test double) for an API key"""
+    key = api_key or resolve_api_key()
+    with _lock:
+        _clients[key] = client
+
+
+def set_async_client(client, api_key=None):
+    """Install an async client for an API key on the running event loop"""
+    import asyncio
+    key = api_key or resolve_api_key()
+    loop = asyncio.get_running_loop()
+    with _lock:
+        _async_clients.setdefault(loop, {})[key] = client
+
+
+def reset_clients():
+    """Close and forget every pooled client and the cached API key"""
+    global _api_key
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+        # Async clients can only be closed from their own loop; drop them
+        _async_clients.clear()
+        _api_key = None
+    for client in clients:
+        try:
+            client.close()
+        except Exception as e:
+            logger.warning(f"Error closing Groq client: {str(e)}")
+
+
+def client_stats():
+    """Counters showing how often clients and connections were reused"""
+    with _lock:
+        stats = dict(_stats)
+    stats["connections_reused"] = max(stats["requests"] - stats["connections_opened"], 0)
+    return stats
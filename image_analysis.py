@@ -1,39 +1,154 @@
+import os
 import cv2
 import numpy as np
 from PIL import Image
 
-def analyze_image_colors(image_path, max_size=1000, quality=0.8):
-    """Analyze dominant colors in an image with memory optimization"""
+# Reduced-resolution decode flags: libjpeg scales by 1/2, 1/4 or 1/8 while decoding
+_REDUCED_COLOR = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+def image_size(image_path):
+    """(width, height) from the file header without decoding pixels, as OpenCV would orient it"""
+    with Image.open(image_path) as im:
+        width, height = im.size
+        # OpenCV applies the EXIF orientation; orientations 5-8 swap the axes
+        if im.getexif().get(0x0112) in (5, 6, 7, 8):
+            width, height = height, width
+    return width, height
+
+def reduced_decode_flag(width, height, max_size):
+    """Largest decode-time reduction that still leaves at least max_size pixels on the long side"""
+    for factor, flag in _REDUCED_COLOR:
+        if max(width, height) // factor >= max_size:
+            return flag
+    return cv2.IMREAD_COLOR
+
+def _load_for_analysis(image_path, max_size):
+    """Decode image_path once, at most max_size on the long side; return (RGB image, width, height)"""
+    # Size from the header, so the image is decoded only once
     try:
-        # First check image validity with grayscale read
-        gray = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-        if gray is None:
-            raise ValueError("Could not read image file")
-            
-        # Calculate resize scale if needed
-        height, width = gray.shape
-        scale = 1.0
-        if max(height, width) > max_size:
-            scale = max_size / max(height, width)
-            
-        # Read full color image at appropriate quality
-        img = cv2.imread(image_path, cv2.IMREAD_REDUCED_COLOR_2 if scale < 0.5 else cv2.IMREAD_COLOR)
-        if scale < 1.0:
-            img = cv2.resize(img, (0,0), fx=scale, fy=scale)
-            
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        width, height = image_size(image_path)
+        flag = reduced_decode_flag(width, height, max_size)
+    except Exception:
+        # Format PIL cannot read: decode at full size and measure that
+        width = height = None
+        flag = cv2.IMREAD_COLOR
+
+    img = cv2.imread(image_path, flag)
+    if img is None:
+        raise ValueError("Could not read image file")
+    if width is None:
+        height, width = img.shape[:2]
+
+    # Finish the reduction the decoder could not do exactly
+    if max(img.shape[:2]) > max_size:
+        scale = max_size / max(img.shape[:2])
+        img = cv2.resize(img, (0,0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
         
-        # Sample pixels for faster processing
-        pixels = img.reshape((-1, 3))
-        if len(pixels) > 10000:  # Sample if too many pixels
-            pixels = pixels[np.random.choice(len(pixels), 10000, replace=False)]
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB), width, height
+
+def minibatch_kmeans(points, k=3, batch_size=1024, iterations=30, seed=0):
+    """Mini-batch k-means (Sculley 2010) in numpy; the same seed always gives the same centers"""
+    rng = np.random.default_rng(seed)
+    points = np.asarray(points, dtype=np.float32)
+    k = min(k, len(points))
+
+    # k-means++ seeding
+    centers = [points[rng.integers(len(points))]]
+    for _ in range(1, k):
+        dist = ((points[:, None, :] - np.array(centers)[None, :, :]) ** 2).sum(axis=2).min(axis=1)
+        total = dist.sum()
+        index = rng.choice(len(points), p=dist / total) if total > 0 else rng.integers(len(points))
+        centers.append(points[index])
+    centers = np.array(centers, dtype=np.float32)
+
+    counts = np.zeros(k)
+    for _ in range(iterations):
+        batch = points[rng.integers(0, len(points), size=min(batch_size, len(points)))]
+        nearest = ((batch[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+        # Per-center learning rate 1/count: move each center towards the mean of its batch members
+        hits = np.bincount(nearest, minlength=k)
+        sums = np.zeros_like(centers)
+        np.add.at(sums, nearest, batch)
+        counts += hits
+        moved = hits > 0
+        rate = (hits[moved] / counts[moved])[:, None]
+        centers[moved] += rate * (sums[moved] / hits[moved][:, None] - centers[moved])
+    return centers
+
+# Histogram mode: bits kept per channel (4 -> 16 levels, 4096 bins) and the
+# minimum distance, in bins, between two reported colours
+HISTOGRAM_BITS = 4
+HISTOGRAM_MIN_SEPARATION = 3
+
+def histogram_colors(pixels, k=3, bits=HISTOGRAM_BITS, min_separation=HISTOGRAM_MIN_SEPARATION):
+    """Dominant colours from a 3-D RGB histogram in one pass over every pixel.
+
+    Each pixel is binned on its top bits per channel; the most populated bins
+    win, skipping bins within min_separation of one already chosen, and each
+    is reported as the mean colour of its pixels. Deterministic.
+    """
+    pixels = np.asarray(pixels, dtype=np.uint8).reshape(-1, 3)
+    shift = 8 - bits
+    levels = 1 << bits
+    # Bin index in 16-bit integers: much cheaper than widening every pixel to intp
+    q = pixels >> shift
+    index = (q[:, 0].astype(np.uint16) << (2 * bits)) | (q[:, 1].astype(np.uint16) << bits) | q[:, 2]
+    size = levels ** 3
+    counts = np.bincount(index, minlength=size)
+
+    # Bin coordinates, to keep the chosen colours apart
+    coords = np.stack(np.unravel_index(np.arange(size), (levels,) * 3), axis=1)
+    chosen = []
+    # Stable sort: ties go to the lower bin index, so the result never varies
+    for b in np.argsort(-counts, kind="stable"):
+        if not counts[b] or len(chosen) == k:
+            break
+        if all(np.abs(coords[b] - coords[c]).max() >= min_separation for c in chosen):
+            chosen.append(b)
+    # Bin means from a fixed stride of the pixels: deterministic, and the
+    # chosen bins are by construction the most populated ones
+    step = max(1, len(pixels) // 65536)
+    sample, sample_index = pixels[::step], index[::step]
+    colors = []
+    for b in chosen:
+        members = sample[sample_index == b]
+        if not len(members):
+            members = pixels[index == b]
+        colors.append(members.mean(axis=0))
+    return colors
+
+METHODS = ("kmeans", "minibatch", "histogram")
+
+def analyze_image_colors(image_path, max_size=1000, quality=0.8, method="kmeans", seed=None):
+    """Analyze dominant colors in an image with memory optimization.
+
+    method "kmeans" uses cv2.kmeans with random restarts; "minibatch" uses
+    minibatch_kmeans, which is faster and reproducible for a given seed;
+    "histogram" uses histogram_colors over every pixel, which needs no
+    sampling and always gives the same answer.
+    """
+    try:
+        img, width, height = _load_for_analysis(image_path, max_size)
         
-        # Get dominant colors using k-means with reduced iterations
-        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 50, 0.1)
-        _, _, centers = cv2.kmeans(
-            pixels.astype(np.float32),
-            3, None, criteria, 5, cv2.KMEANS_RANDOM_CENTERS
-        )
+        pixels = img.reshape((-1, 3))
+        if method == "histogram":
+            # Every pixel, one pass: no sampling needed
+            centers = histogram_colors(pixels, 3)
+        elif method in ("kmeans", "minibatch"):
+            # Sample pixels for faster processing
+            if len(pixels) > 10000:
+                pixels = pixels[np.random.default_rng(seed).choice(len(pixels), 10000, replace=False)]
+            if method == "minibatch":
+                centers = minibatch_kmeans(pixels, 3, seed=seed)
+            else:
+                # Get dominant colors using k-means with reduced iterations
+                criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 50, 0.1)
+                _, _, centers = cv2.kmeans(
+                    pixels.astype(np.float32),
+                    3, None, criteria, 5, cv2.KMEANS_RANDOM_CENTERS
+                )
+        else:
+            raise ValueError(f"Unknown method '{method}'")
         
         # Convert centers to hex colors
         colors = [f"#{int(c[0]):02x}{int(c[1]):02x}{int(c[2]):02x}" for c in centers]
@@ -46,15 +161,141 @@ def analyze_image_colors(image_path, max_size=1000, quality=0.8):
     except Exception as e:
         raise ValueError(f"Image analysis error: {str(e)}")
 
-def detect_edges(image_path):
-    """Detect edges in an image"""
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp", ".tif", ".tiff")
+
+def _init_worker():
+    # One OpenCV thread per process; the pool already provides the parallelism
+    cv2.setNumThreads(1)
+
+def _analyze_one(job):
+    image_path, max_size, method, seed = job
+    try:
+        result = analyze_image_colors(image_path, max_size=max_size, method=method, seed=seed)
+    except ValueError as e:
+        result = {"error": str(e)}
+    result["path"] = image_path
+    return result
+
+def analyze_image_collection(images, max_size=1000, method="minibatch", seed=0, workers=None):
+    """Dominant colours for many images, in input order.
+
+    images is a list of paths or a directory (its image files are taken in
+    name order). Decoding and clustering are spread over a process pool.
+    A failed image gets an "error" entry instead of stopping the batch.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    if isinstance(images, (str, os.PathLike)) and os.path.isdir(images):
+        images = sorted(
+            os.path.join(images, name) for name in os.listdir(images)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+    jobs = [(str(path), max_size, method, seed) for path in images]
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    if workers <= 1:
+        return [_analyze_one(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        # map() yields results in submission order
+        return list(pool.map(_analyze_one, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
+
+# Suggested memory cap for detect_edges callers that opt into one (override with EDGE_MAX_BYTES)
+EDGE_MAX_BYTES = int(os.environ.get("EDGE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Canny's gradients, magnitudes and maps take roughly this many bytes per pixel
+_CANNY_BYTES_PER_PIXEL = 12
+# Rows shared by neighbouring strips so edges line up across strip boundaries
+_STRIP_OVERLAP = 16
+_REDUCED_GRAYSCALE = ((1, cv2.IMREAD_GRAYSCALE), (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+                      (4, cv2.IMREAD_REDUCED_GRAYSCALE_4), (8, cv2.IMREAD_REDUCED_GRAYSCALE_8))
+
+def edge_thresholds(gray, method="median"):
+    """Canny (low, high) thresholds for a grayscale image: "median", "otsu" or an explicit pair"""
+    if not isinstance(method, str):
+        low, high = method
+        return float(low), float(high)
+    # calcHist counts in place; np.bincount would first widen every pixel to intp
+    hist = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel().astype(np.float64)
+    if method == "median":
+        median = int(np.searchsorted(np.cumsum(hist), gray.size / 2))
+        sigma = 0.33
+        return max(0.0, (1 - sigma) * median), min(255.0, (1 + sigma) * median)
+    if method == "otsu":
+        # Otsu's threshold from the histogram (cv2.threshold would allocate a full-size output)
+        p = hist / hist.sum()
+        omega = np.cumsum(p)
+        mu = np.cumsum(p * np.arange(256))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            between = (mu[-1] * omega - mu) ** 2 / (omega * (1 - omega))
+        otsu = float(np.nanargmax(np.nan_to_num(between)))
+        return 0.5 * otsu, otsu
+    raise ValueError(f"Unknown threshold method '{method}'")
+
+def _decode_gray(image_path, max_bytes, output_bytes_per_pixel):
+    """Grayscale decode at the largest 1/1-1/8 scale whose image and output fit in max_bytes.
+
+    Returns (image, factor); the image is 1/factor of the source size.
+    """
+    factor, flag = _REDUCED_GRAYSCALE[0]
+    if max_bytes:
+        try:
+            width, height = image_size(image_path)
+        except Exception:
+            width = height = None
+        if width:
+            for factor, flag in _REDUCED_GRAYSCALE:
+                pixels = (width // factor) * (height // factor)
+                # Leave a quarter of the budget for Canny's working strips
+                if pixels * (1 + output_bytes_per_pixel) <= max_bytes * 0.75:
+                    break
+    return cv2.imread(image_path, flag), factor
+
+def detect_edges(image_path, thresholds="median", max_bytes=None, packed=False, return_scale=False):
+    """Detect edges in an image.
+
+    thresholds is "median", "otsu" or a (low, high) pair such as the old
+    (100, 200). The edge map is full resolution unless max_bytes is given
+    (e.g. EDGE_MAX_BYTES): memory then stays roughly within it (the JPEG
+    decoder's own buffers aside), the image being decoded at 1/2, 1/4 or
+    1/8 scale if it would not fit and Canny running over horizontal strips.
+    Returns a uint8 edge map (0/255), or with packed=True the same map
+    bit-packed along rows (np.packbits, 1/8 of the size; see unpack_edges).
+    With return_scale=True returns (edges, scale), where edge pixel (x, y)
+    covers source pixel (x * scale, y * scale).
+    """
     try:
-        img = cv2.imread(image_path, 0)
-        if img is None:
+        gray, scale = _decode_gray(image_path, max_bytes, 1 / 8 if packed else 1)
+        if gray is None:
             raise ValueError("Could not read image file")
-            
-        edges = cv2.Canny(img, 100, 200)
-        return edges
+
+        low, high = edge_thresholds(gray, thresholds)
+        height, width = gray.shape
+        if packed:
+            edges = np.empty((height, (width + 7) // 8), dtype=np.uint8)
+        else:
+            edges = np.empty((height, width), dtype=np.uint8)
+
+        rows = height
+        if max_bytes:
+            budget = max_bytes - gray.nbytes - edges.nbytes
+            rows = max(64, budget // (width * _CANNY_BYTES_PER_PIXEL))
+        for top in range(0, height, rows):
+            bottom = min(height, top + rows)
+            start = max(0, top - _STRIP_OVERLAP)
+            strip = cv2.Canny(gray[start:min(height, bottom + _STRIP_OVERLAP)], low, high)
+            strip = strip[top - start:bottom - start]
+            edges[top:bottom] = np.packbits(strip, axis=1) if packed else strip
+        return (edges, scale) if return_scale else edges
         
     except Exception as e:
         raise ValueError(f"Edge detection error: {str(e)}")
+
+def unpack_edges(packed, width):
+    """Expand a packed edge map from detect_edges(packed=True) back to uint8 0/255"""
+    return np.unpackbits(packed, axis=1, count=width) * np.uint8(255)
+
+def save_edges(edges, path, width=None):
+    """Write an edge map as a 1-bit PNG; pass width when edges is packed"""
+    if width is None:
+        image = Image.fromarray(edges > 0)
+    else:
+        # np.packbits rows use the same MSB-first, byte-padded layout as PIL's mode "1"
+        image = Image.frombytes("1", (width, edges.shape[0]), edges.tobytes())
+    image.save(path, format="PNG", optimize=True)
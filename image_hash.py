@@ -0,0 +1,183 @@
+# Perceptual hashes and a near-duplicate index so re-uploads of the same photo reuse earlier analyses
+import base64
+import json
+import logging
+import os
+import threading
+
+import cv2
+import numpy as np
+
+from diagnosis_cache import get_cache, make_key
+
+logger = logging.getLogger(__name__)
+
+# Bits (out of 64) two hashes may differ by and still count as the same photo.
+# Recompression, resizing and small exposure changes stay well under this;
+# different photos of the same scene usually differ by 15 bits or more.
+PHASH_MAX_DISTANCE = int(os.environ.get("PHASH_MAX_DISTANCE", "6"))
+# Most recent images remembered per prompt/language/model
+PHASH_INDEX_SIZE = int(os.environ.get("PHASH_INDEX_SIZE", "500"))
+# Flat or low-contrast photos hash to almost all-0 or all-1 bits and so collide with
+# each other; below this grey-level spread, or with fewer than PHASH_MIN_BITS set
+# (or clear), an image gets no hash and only an exact content match is reused
+PHASH_MIN_STDDEV = float(os.environ.get("PHASH_MIN_STDDEV", "10"))
+PHASH_MIN_BITS = int(os.environ.get("PHASH_MIN_BITS", "8"))
+HASH_METHODS = ("dhash", "phash")
+
+
+def _gray(img):
+    return img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+def _bits_to_int(bits):
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+
+def dhash(img, hash_size=8):
+    """Difference hash: whether each pixel of a (hash_size+1) x hash_size thumbnail is brighter than its left neighbour"""
+    small = cv2.resize(_gray(img), (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    return _bits_to_int(small[:, 1:] > small[:, :-1])
+
+
+def phash(img, hash_size=8):
+    """DCT hash: low-frequency coefficients of a 32x32 thumbnail compared with their median"""
+    small = cv2.resize(_gray(img), (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:hash_size, :hash_size].ravel()
+    # The DC term is just the mean brightness
+    return _bits_to_int(low > np.median(low[1:]))
+
+
+def image_hash(img, method="dhash"):
+    """64-bit perceptual hash of a decoded image"""
+    if method not in HASH_METHODS:
+        raise ValueError(f"method must be one of {', '.join(HASH_METHODS)}, not '{method}'")
+    return dhash(img) if method == "dhash" else phash(img)
+
+
+def distinctive(img, value, min_stddev=PHASH_MIN_STDDEV, min_bits=PHASH_MIN_BITS):
+    """Whether a grayscale image and its hash carry enough detail to match on the hash alone"""
+    if float(img.std()) < min_stddev:
+        return False
+    return min_bits <= bin(value).count("1") <= 64 - min_bits
+
+
+def encoded_image_hash(encoded_image, method="dhash"):
+    """Perceptual hash of a base64 JPEG from encode_image.
+
+    None if it does not decode or is too flat to tell apart from other
+    flat images (see distinctive); such images are only matched exactly.
+    """
+    try:
+        data = np.frombuffer(base64.b64decode(encoded_image), dtype=np.uint8)
+        img = cv2.imdecode(data, cv2.IMREAD_GRAYSCALE)
+    except (ValueError, TypeError, cv2.error):
+        return None
+    if img is None:
+        return None
+    value = image_hash(img, method)
+    if not distinctive(img, value):
+        logger.info("Image too uniform for near-duplicate matching; only exact copies are reused")
+        return None
+    return value
+
+
+def hamming_distances(hashes, value):
+    """Bit differences between value and each of hashes"""
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    diff = np.bitwise_xor(hashes, np.uint64(value))
+    return np.unpackbits(diff.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class ImageHashIndex:
+    """Perceptual hashes of analyzed images, grouped by scope (prompt, language, model).
+
+    Each scope's list is stored in the diagnosis cache next to the analyses it
+    points at, so it shares the cache's TTL and is visible to every worker.
+    Concurrent writers from different processes may drop each other's newest
+    entry; that only costs a future cache miss.
+    """
+
+    def __init__(self, cache=None, max_distance=PHASH_MAX_DISTANCE, max_entries=PHASH_INDEX_SIZE,
+                 method="dhash"):
+        self._cache = cache
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.method = method
+        self._lock = threading.Lock()
+        self._stats = {"lookups": 0, "matches": 0, "added": 0}
+
+    @property
+    def cache(self):
+        return self._cache or get_cache()
+
+    def _key(self, scope):
+        return make_key("image-hash-index", self.method, scope)
+
+    def _load(self, scope):
+        raw = self.cache.get(self._key(scope))
+        if raw is None:
+            return [], []
+        entries = json.loads(raw)
+        return [int(h, 16) for h in entries["hashes"]], entries["values"]
+
+    def add(self, scope, image_hash, value):
+        """Remember that an image with image_hash produced value (usually a cache key) in scope"""
+        if image_hash is None:
+            return
+        with self._lock:
+            hashes, values = self._load(scope)
+            if value in values:
+                return
+            hashes = (hashes + [image_hash])[-self.max_entries:]
+            values = (values + [value])[-self.max_entries:]
+            self.cache.set(self._key(scope), json.dumps({
+                "hashes": [format(h, "016x") for h in hashes],
+                "values": values,
+            }))
+            self._stats["added"] += 1
+
+    def candidates(self, scope, image_hash):
+        """Values of similar images in scope, nearest first, as (value, distance) pairs"""
+        if image_hash is None:
+            return []
+        with self._lock:
+            self._stats["lookups"] += 1
+        hashes, values = self._load(scope)
+        if not hashes:
+            return []
+        distances = hamming_distances(hashes, image_hash)
+        order = np.argsort(distances, kind="stable")
+        return [(values[i], int(distances[i])) for i in order if distances[i] <= self.max_distance]
+
+    def lookup(self, scope, image_hash, resolve=None):
+        """First near match whose value resolve() accepts, as (resolved, distance), or None.
+
+        resolve maps a stored value to a result (e.g. a cache lookup) and
+        returns None for values that are no longer usable.
+        """
+        for value, distance in self.candidates(scope, image_hash):
+            result = value if resolve is None else resolve(value)
+            if result is not None:
+                with self._lock:
+                    self._stats["matches"] += 1
+                logger.info(f"Near-duplicate image ({distance} bits apart); reusing earlier analysis")
+                return result, distance
+        return None
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """Process-wide index, created on first use"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = ImageHashIndex()
+        return _index
@@ -0,0 +1,189 @@
+# Pre-rendered speech for the fixed text in every response (disclaimers, prescription headings, fallback lines)
+#
+#   python phrase_bank.py    render every phrase into the voice cache ahead of time
+#
+# At run time lines that consist of a fixed phrase are cut out of the text, only
+# what is left goes to TTS, and the MP3 pieces are joined back together in order.
+# Phrases are rendered on first use; set PHRASE_BANK_WARM_UP=1 to have the apps
+# render them all in the background at startup.
+import logging
+import os
+import re
+import threading
+from functools import lru_cache
+
+from speech_chunks import ChunkedSpeech, get_executor, gtts_mp3
+from tts_cache import get_voice_cache, speech_key
+
+logger = logging.getLogger(__name__)
+
+PHRASE_BANK_WARM_UP = os.environ.get("PHRASE_BANK_WARM_UP", "0") == "1"
+
+# gTTS language codes for the response languages
+LANGUAGE_CODES = {"English": "en", "Hindi": "hi", "Marathi": "mr"}
+
+
+def _language(lang_code):
+    """Response language for a gTTS code such as "hi" or "en-uk" """
+    base = lang_code.split("-")[0]
+    for language, code in LANGUAGE_CODES.items():
+        if code == base:
+            return language
+    return "English"
+
+
+def phrases(language):
+    """The fixed lines brain_of_the_doctor puts into responses in language"""
+    from brain_of_the_doctor import (
+        ANALYSIS_NOTES, ERROR_MEDICATIONS, FALLBACK_MEDICATIONS, PRESCRIPTION_TEMPLATES,
+    )
+    found = [ANALYSIS_NOTES.get(language)]
+    found += FALLBACK_MEDICATIONS.get(language, []) + ERROR_MEDICATIONS.get(language, [])
+    # Only complete template lines: a label such as "Date:" also turns up in free text
+    for line in PRESCRIPTION_TEMPLATES.get(language, "").splitlines():
+        if "{" not in line:
+            found.append(line.strip())
+    return sorted({phrase for phrase in found if phrase and re.search(r"\w", phrase)}, key=len, reverse=True)
+
+
+@lru_cache(maxsize=None)
+def _pattern(language):
+    # A phrase only counts when it is the whole line (a list bullet and closing dots aside),
+    # so the same words inside a sentence of model text are left to be spoken with it
+    alternatives = "|".join(re.escape(phrase) for phrase in phrases(language))
+    return re.compile(r"^[ \t]*(?:- )?(" + alternatives + r")[ \t.]*$", re.MULTILINE)
+
+
+def segments(text, lang_code):
+    """Split text into (piece, is_fixed) pairs, in order; fixed pieces are whole lines with pre-rendered speech"""
+    pieces = []
+    for i, piece in enumerate(_pattern(_language(lang_code)).split(text or "")):
+        fixed = i % 2 == 1
+        if fixed or re.search(r"\w", piece):
+            pieces.append((piece.strip(), fixed))
+    return pieces
+
+
+class PhraseBank:
+    """MP3 for each fixed phrase, kept in memory and in the voice cache so every worker renders it once"""
+
+    def __init__(self, synthesize=gtts_mp3, cache=None):
+        self.synthesize = synthesize
+        self._cache = cache
+        self._audio = {}
+        self._lock = threading.Lock()
+        self._stats = {"served": 0, "rendered": 0}
+
+    @property
+    def cache(self):
+        return self._cache or get_voice_cache()
+
+    def audio(self, phrase, lang_code):
+        """MP3 bytes for phrase, rendering and storing it on first use"""
+        with self._lock:
+            audio = self._audio.get((phrase, lang_code))
+        if audio is None:
+            key = speech_key(phrase, lang_code, "phrase")
+            path = self.cache.get(key, ".mp3")
+            if path:
+                try:
+                    with open(path, "rb") as f:
+                        audio = f.read()
+                except FileNotFoundError:
+                    # Evicted by another writer between get() and open()
+                    audio = None
+            if audio is None:
+                audio = self.synthesize(phrase, lang_code)
+                with self.cache.writing(key, ".mp3") as temp_path:
+                    with open(temp_path, "wb") as f:
+                        f.write(audio)
+                with self._lock:
+                    self._stats["rendered"] += 1
+            with self._lock:
+                self._audio[(phrase, lang_code)] = audio
+        with self._lock:
+            self._stats["served"] += 1
+        return audio
+
+    def build(self, languages=tuple(LANGUAGE_CODES), parallel=True):
+        """Render every phrase for languages; returns how many phrases are ready.
+
+        parallel uses the shared TTS pool; the startup warm-up renders one
+        phrase at a time instead so it never crowds out live requests.
+        """
+        jobs = [(phrase, LANGUAGE_CODES[language]) for language in languages for phrase in phrases(language)]
+        if parallel:
+            futures = [get_executor().submit(self.audio, *job) for job in jobs]
+            results = [future.exception() for future in futures]
+        else:
+            results = []
+            for job in jobs:
+                try:
+                    self.audio(*job)
+                    results.append(None)
+                except Exception as e:
+                    results.append(e)
+        for error in filter(None, results):
+            logger.warning(f"Phrase bank: could not render a phrase: {str(error)}")
+        return results.count(None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["phrases"] = len(self._audio)
+        return stats
+
+
+_bank = None
+_bank_lock = threading.Lock()
+_warm_up_started = False
+
+
+def get_bank():
+    """Process-wide phrase bank, created on first use"""
+    global _bank
+    with _bank_lock:
+        if _bank is None:
+            _bank = PhraseBank()
+        return _bank
+
+
+def warm_up(force=False):
+    """Start building the phrase bank in the background (once per process).
+
+    Does nothing unless PHRASE_BANK_WARM_UP=1 or force is set, so CI and
+    replay runs do not send a burst of gTTS requests on every start.
+    """
+    global _warm_up_started
+    if not (PHRASE_BANK_WARM_UP or force):
+        return
+    with _bank_lock:
+        if _warm_up_started:
+            return
+        _warm_up_started = True
+    threading.Thread(target=get_bank().build, kwargs={"parallel": False}, name="phrase-bank", daemon=True).start()
+
+
+def synthesize_with_phrases(text, lang_code, on_first_chunk=None):
+    """MP3 for text with fixed phrases spliced in from the bank and the rest rendered in parallel chunks"""
+    executor = get_executor()
+    parts = [
+        executor.submit(get_bank().audio, piece, lang_code) if fixed else ChunkedSpeech(piece, lang_code, executor=executor)
+        for piece, fixed in segments(text, lang_code)
+    ]
+    try:
+        if on_first_chunk is not None and parts:
+            first = parts[0]
+            on_first_chunk(first.first() if isinstance(first, ChunkedSpeech) else first.result())
+        return b"".join(part.result() for part in parts)
+    except BaseException:
+        for part in parts:
+            part.cancel()
+        raise
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    bank = get_bank()
+    total = sum(len(phrases(language)) for language in LANGUAGE_CODES)
+    print(f"Rendered {bank.build()} of {total} phrases into {bank.cache.directory}")
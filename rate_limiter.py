@@ -0,0 +1,338 @@
+# Process-wide rate limiter and retry scheduler for Groq calls
+import email.utils
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Account quotas (override through environment variables; 0 disables a limit).
+# The defaults are Groq's free-tier limits for llama-3.1-8b-instant.
+GROQ_RPM = float(os.environ.get("GROQ_RPM", "30"))
+GROQ_TPM = float(os.environ.get("GROQ_TPM", "6000"))
+# Fraction of the quota actually used, so bursts from other clients do not tip us over
+GROQ_RATE_HEADROOM = float(os.environ.get("GROQ_RATE_HEADROOM", "0.9"))
+# Upper bound for concurrent requests; halved on every 429 and regrown on success
+GROQ_MAX_CONCURRENCY = int(os.environ.get("GROQ_MAX_CONCURRENCY", "8"))
+GROQ_MAX_RETRIES = int(os.environ.get("GROQ_MAX_RETRIES", "3"))
+GROQ_BACKOFF_BASE = float(os.environ.get("GROQ_BACKOFF_BASE", "1"))
+GROQ_BACKOFF_CAP = float(os.environ.get("GROQ_BACKOFF_CAP", "30"))
+
+# How often an async caller waiting for a concurrency slot looks again (threads wait on a condition)
+_ASYNC_SLOT_POLL = 0.05
+
+
+class TokenBucket:
+    """Refills continuously at per_minute / 60 units per second, holding at most one minute's worth"""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until amount units are available (0 if they are now)"""
+        if not self.capacity:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount):
+        if self.capacity:
+            self.level -= min(amount, self.capacity)
+
+    def give_back(self, amount):
+        """Return over-reserved units (or take more when amount is negative)"""
+        if self.capacity:
+            self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """RPM/TPM token buckets plus an AIMD concurrency window shared by every thread.
+
+    Callers reserve a request and an estimated token count before each call
+    and settle() the reservation to the tokens the response reports. A 429
+    halves the concurrency window and pauses every caller until the server's
+    Retry-After has passed; each success grows the window back. Waiting
+    threads sleep on a condition that release(), settle() and throttled()
+    notify; async callers wait on the event loop.
+    """
+
+    def __init__(self, rpm=GROQ_RPM, tpm=GROQ_TPM, max_concurrency=GROQ_MAX_CONCURRENCY,
+                 headroom=GROQ_RATE_HEADROOM):
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._requests = TokenBucket(rpm * headroom)
+        self._tokens = TokenBucket(tpm * headroom)
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency = float(self.max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._stats = {"calls": 0, "retries": 0, "rate_limited": 0, "failures": 0, "wait_seconds": 0.0}
+
+    def _try_start(self, tokens):
+        """Admit the call and return 0, or return how long to wait (None: until a slot frees up).
+
+        Called with the lock held.
+        """
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.in_flight >= int(self.concurrency):
+            return None
+        wait = max(self._requests.wait_time(1, now), self._tokens.wait_time(tokens, now))
+        if wait:
+            return wait
+        self._requests.take(1)
+        self._tokens.take(tokens)
+        self.in_flight += 1
+        self._stats["calls"] += 1
+        return 0.0
+
+    def acquire(self, tokens=0, blocking=True):
+        """Block until a call costing tokens may start; with blocking=False, return whether it started"""
+        started = time.monotonic()
+        with self._changed:
+            while True:
+                wait = self._try_start(tokens)
+                if wait == 0:
+                    break
+                if not blocking:
+                    return False
+                self._changed.wait(wait)
+            self._stats["wait_seconds"] += time.monotonic() - started
+        return True
+
+    async def acquire_async(self, tokens=0):
+        """Wait on the event loop until a call costing tokens may start.
+
+        Nothing is reserved until the slot is actually taken, so cancelling
+        the waiting task cannot leak a slot or tokens.
+        """
+        import asyncio
+        started = time.monotonic()
+        while True:
+            with self._changed:
+                wait = self._try_start(tokens)
+                if wait == 0:
+                    self._stats["wait_seconds"] += time.monotonic() - started
+                    return
+            await asyncio.sleep(_ASYNC_SLOT_POLL if wait is None else wait)
+
+    def release(self, ok=True, refund=0):
+        """Free the call's slot; refund gives back tokens reserved for an attempt that failed"""
+        with self._changed:
+            self.in_flight -= 1
+            if refund:
+                self._tokens.give_back(refund)
+            if ok and self.concurrency < self.max_concurrency:
+                # Additive increase: roughly one extra slot per window of successes
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1.0 / self.concurrency)
+            self._changed.notify_all()
+
+    def settle(self, reserved, used):
+        """Correct a reservation of reserved tokens to the used tokens the response reported"""
+        if used is None or used == reserved:
+            return
+        with self._changed:
+            self._tokens.give_back(reserved - used)
+            self._changed.notify_all()
+
+    def throttled(self, retry_after):
+        """A 429 came back: shrink the window and hold every caller until retry_after has passed"""
+        with self._changed:
+            self.concurrency = max(1.0, self.concurrency / 2)
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            self._stats["rate_limited"] += 1
+            concurrency = int(self.concurrency)
+            self._changed.notify_all()
+        logger.warning(f"Groq rate limit hit; pausing {retry_after:.1f}s, concurrency now {concurrency}")
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._stats[name] += n
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["concurrency"] = int(self.concurrency)
+            stats["in_flight"] = self.in_flight
+        return stats
+
+
+def estimate_tokens(kwargs):
+    """Rough token cost of a chat request: ~4 characters per prompt token plus the completion budget.
+
+    This is only the reservation; groq_call settles it to the usage the response reports.
+    """
+    chars = 0
+    for message in kwargs.get("messages") or []:
+        content = message.get("content", "") if isinstance(message, dict) else ""
+        if isinstance(content, list):
+            content = " ".join(str(part.get("text", "")) for part in content if isinstance(part, dict))
+        chars += len(str(content))
+    return chars // 4 + int(kwargs.get("max_tokens") or 0)
+
+
+def used_tokens(response):
+    """Total tokens a response (or a stream chunk carrying x_groq.usage) reports, or None"""
+    usage = getattr(response, "usage", None) or getattr(getattr(response, "x_groq", None), "usage", None)
+    total = getattr(usage, "total_tokens", None)
+    return total if isinstance(total, int) else None
+
+
+def _retry_after(error):
+    """Seconds the server asked us to wait, from retry-after-ms or Retry-After, if any"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+    except ValueError:
+        pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    # Retry-After may also be an HTTP date
+    try:
+        parsed = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(parsed.timestamp() - time.time(), 0.0)
+
+
+def _classify(error):
+    """Return 'rate_limited', 'retry' or None (do not retry) for an exception from the SDK"""
+    import groq
+    if isinstance(error, groq.RateLimitError) or getattr(error, "status_code", None) == 429:
+        return "rate_limited"
+    if isinstance(error, (groq.APIConnectionError, groq.InternalServerError)):
+        return "retry"
+    return None
+
+
+def _backoff(attempt):
+    """Full-jitter exponential backoff, so retrying threads do not line up"""
+    return random.uniform(0, min(GROQ_BACKOFF_CAP, GROQ_BACKOFF_BASE * 2 ** attempt))
+
+
+# One limiter per model: Groq's quotas are per model, so Whisper and the chat models do not share buckets
+_limiters = {}
+_limiter_lock = threading.Lock()
+
+
+def get_limiter(model=None):
+    """Process-wide limiter for model, created on first use"""
+    with _limiter_lock:
+        if model not in _limiters:
+            _limiters[model] = RateLimiter()
+        return _limiters[model]
+
+
+def set_limiter(limiter, model=None):
+    """Replace the limiter for model (e.g. with that model's quotas)"""
+    with _limiter_lock:
+        _limiters[model] = limiter
+
+
+def _next_delay(limiter, error, attempt, max_retries):
+    """Delay before the next attempt, or None if error should be raised"""
+    kind = _classify(error)
+    if kind is None or attempt >= max_retries - 1:
+        limiter._count("failures")
+        return None
+    delay = _backoff(attempt)
+    if kind == "rate_limited":
+        retry_after = _retry_after(error)
+        delay = retry_after if retry_after is not None else delay
+        limiter.throttled(delay)
+        # The pause is enforced in acquire(); add jitter so waiters do not all resume at once
+        delay = random.uniform(0, GROQ_BACKOFF_BASE)
+    limiter._count("retries")
+    logger.info(f"Retrying Groq call in {delay:.1f}s after: {str(error)}")
+    return delay
+
+
+def _settled_stream(stream, limiter, tokens):
+    """Yield a streamed response's chunks, settling the reservation when the usage chunk arrives"""
+    for chunk in stream:
+        used = used_tokens(chunk)
+        if used is not None:
+            limiter.settle(tokens, used)
+        yield chunk
+
+
+def groq_call(func, *args, max_retries=GROQ_MAX_RETRIES, tokens=None, **kwargs):
+    """Call a Groq SDK method under the model's shared limiter, retrying 429s, timeouts and 5xx.
+
+    tokens defaults to an estimate from the messages and max_tokens kwargs;
+    the reservation is corrected to the response's usage once it is known
+    (for streams, when the final chunk arrives). The last error is re-raised
+    once max_retries attempts have failed.
+    """
+    limiter = get_limiter(kwargs.get("model"))
+    tokens = estimate_tokens(kwargs) if tokens is None else tokens
+    attempt = 0
+    while True:
+        limiter.acquire(tokens)
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            limiter.release(ok=False, refund=tokens)
+            delay = _next_delay(limiter, e, attempt, max_retries)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            attempt += 1
+            continue
+        limiter.release()
+        if kwargs.get("stream"):
+            return _settled_stream(result, limiter, tokens)
+        limiter.settle(tokens, used_tokens(result))
+        return result
+
+
+async def groq_call_async(func, *args, max_retries=GROQ_MAX_RETRIES, tokens=None, **kwargs):
+    """Async version of groq_call for AsyncGroq methods (not for stream=True)"""
+    import asyncio
+    limiter = get_limiter(kwargs.get("model"))
+    tokens = estimate_tokens(kwargs) if tokens is None else tokens
+    attempt = 0
+    while True:
+        await limiter.acquire_async(tokens)
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            limiter.release(ok=False, refund=tokens)
+            delay = _next_delay(limiter, e, attempt, max_retries)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+        limiter.release()
+        limiter.settle(tokens, used_tokens(result))
+        return result
+
+
+def limiter_stats():
+    """Counters for calls, retries, 429s and time spent waiting for quota, per model"""
+    with _limiter_lock:
+        limiters = dict(_limiters)
+    return {model: limiter.stats() for model, limiter in limiters.items()}
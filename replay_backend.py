@@ -0,0 +1,330 @@
+# Record/replay backend for Groq, ElevenLabs and gTTS so the pipeline can run offline
+#
+#   AI_DOCTOR_BACKEND=live    talk to the real services (default)
+#   AI_DOCTOR_BACKEND=record  talk to the real services and save every response as a cassette
+#   AI_DOCTOR_BACKEND=replay  serve saved cassettes locally, never touching the network
+#
+# Groq and ElevenLabs are intercepted at the httpx transport, so retries, rate
+# limiting and response parsing run exactly as they do against the live APIs.
+import base64
+import hashlib
+import io
+import json
+import logging
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+AI_DOCTOR_BACKEND = os.environ.get("AI_DOCTOR_BACKEND", "live").lower()
+AI_DOCTOR_CASSETTE_DIR = os.environ.get("AI_DOCTOR_CASSETTE_DIR", "cassettes")
+# Replay latency in seconds: a fixed value ("0.3") or a uniform range ("0.2-0.8")
+REPLAY_LATENCY = os.environ.get("REPLAY_LATENCY", "0")
+# Fraction of replayed calls that fail, and the HTTP status they fail with
+REPLAY_ERROR_RATE = float(os.environ.get("REPLAY_ERROR_RATE", "0"))
+REPLAY_ERROR_STATUS = int(os.environ.get("REPLAY_ERROR_STATUS", "429"))
+
+# Placeholder key so the SDK clients can be built in replay mode without a real one
+REPLAY_API_KEY = "gsk_replay"
+
+MODES = ("live", "record", "replay")
+
+# Hop-by-hop and encoding headers no longer describe the stored (decoded) body
+_DROP_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection", "keep-alive"}
+
+_lock = threading.Lock()
+_stats = {"recorded": 0, "replayed": 0, "approximate": 0, "misses": 0, "injected_errors": 0}
+_installed = False
+
+
+def backend_mode():
+    """Current backend mode: live, record or replay"""
+    if AI_DOCTOR_BACKEND not in MODES:
+        raise ValueError(f"AI_DOCTOR_BACKEND must be one of {', '.join(MODES)}, not '{AI_DOCTOR_BACKEND}'")
+    return AI_DOCTOR_BACKEND
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+
+def backend_stats():
+    """Counters for recorded, replayed (exact or approximate) and missing cassettes and injected failures"""
+    with _lock:
+        stats = dict(_stats)
+    stats["mode"] = backend_mode()
+    return stats
+
+
+def replay_delay():
+    """Seconds one replayed call should take, drawn from REPLAY_LATENCY"""
+    low, _, high = REPLAY_LATENCY.partition("-")
+    low = float(low or 0)
+    return random.uniform(low, float(high)) if high else low
+
+
+def _inject_error():
+    """True if this replayed call should fail (REPLAY_ERROR_RATE)"""
+    if REPLAY_ERROR_RATE and random.random() < REPLAY_ERROR_RATE:
+        _count("injected_errors")
+        return True
+    return False
+
+
+class Cassette:
+    """Directory of recorded responses, one JSON file per request fingerprint, grouped by route"""
+
+    def __init__(self, directory=AI_DOCTOR_CASSETTE_DIR):
+        self.directory = directory
+
+    def _path(self, kind, key):
+        return os.path.join(self.directory, kind, f"{key}.json")
+
+    def load(self, kind, key):
+        try:
+            with open(self._path(kind, key), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def any(self, kind, prefer=None):
+        """A random recording of this kind, or None if there are none.
+
+        With prefer (a predicate on the record), a matching recording is
+        returned if there is one, otherwise any recording.
+        """
+        try:
+            names = [name for name in os.listdir(os.path.join(self.directory, kind)) if name.endswith(".json")]
+        except FileNotFoundError:
+            return None
+        random.shuffle(names)
+        fallback = None
+        for name in names:
+            record = self.load(kind, name[:-len(".json")])
+            if record is None:
+                continue
+            if prefer is None or prefer(record):
+                return record
+            fallback = fallback or record
+        return fallback
+
+    def save(self, kind, key, record):
+        path = self._path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so a concurrent reader never sees half a cassette
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False, indent=1)
+        os.replace(temp_path, path)
+
+
+def _fingerprint(*parts):
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def request_key(request):
+    """Return (route, fingerprint) for an HTTP request.
+
+    The route is method, host, path and the request options that change the
+    response's shape (model, streaming, JSON mode); the fingerprint adds the
+    normalized body. The prompts vary randomly between calls, so replay
+    falls back to any recording for the same route when there is no exact match.
+    """
+    body = request.read()
+    content_type = request.headers.get("content-type", "")
+    options = None
+    if content_type.startswith("application/json"):
+        try:
+            payload = json.loads(body)
+            body = json.dumps(payload, sort_keys=True).encode("utf-8")
+            if isinstance(payload, dict):
+                options = [payload.get("model"), bool(payload.get("stream")), payload.get("response_format")]
+        except ValueError:
+            pass
+    else:
+        # Multipart boundaries are random per request
+        match = re.search(r"boundary=([^;]+)", content_type)
+        if match:
+            body = body.replace(match.group(1).encode("latin-1"), b"BOUNDARY")
+    route = _fingerprint(request.method, request.url.host, request.url.path, options)
+    return route, _fingerprint(route, hashlib.sha256(body).hexdigest())
+
+
+def _error_response(request, status, message):
+    headers = {"retry-after": "1"} if status == 429 else {}
+    return httpx.Response(
+        status,
+        headers=headers,
+        json={"error": {"message": message, "type": "replay_backend"}},
+        request=request,
+    )
+
+
+def _record_response(cassette, key, request, response, body):
+    headers = {k: v for k, v in response.headers.items() if k.lower() not in _DROP_HEADERS}
+    # Transient failures are not worth replaying forever
+    if response.status_code < 500 and response.status_code != 429:
+        route, fingerprint = key
+        cassette.save(f"http/{route}", fingerprint, {
+            "request": {"method": request.method, "url": str(request.url)},
+            "status": response.status_code,
+            "headers": headers,
+            "body": base64.b64encode(body).decode("ascii"),
+        })
+        _count("recorded")
+    return httpx.Response(response.status_code, headers=headers, content=body, request=request)
+
+
+def _replay_response(cassette, key, request):
+    if _inject_error():
+        return _error_response(request, REPLAY_ERROR_STATUS, "Injected failure")
+    route, fingerprint = key
+    record = cassette.load(f"http/{route}", fingerprint)
+    if record is None:
+        record = cassette.any(f"http/{route}")
+        if record is not None:
+            _count("approximate")
+    if record is None:
+        _count("misses")
+        logger.warning(f"No cassette for {request.method} {request.url.path}")
+        return _error_response(request, 404, f"No cassette recorded for {request.method} {request.url.path}")
+    _count("replayed")
+    return httpx.Response(
+        record["status"],
+        headers=record["headers"],
+        content=base64.b64decode(record["body"]),
+        request=request,
+    )
+
+
+class CassetteTransport(httpx.BaseTransport):
+    """httpx transport that records through to, or replays instead of, the network"""
+
+    def __init__(self, mode, cassette=None, limits=None):
+        self.mode = mode
+        self.cassette = cassette or Cassette()
+        self._inner = httpx.HTTPTransport(limits=limits) if limits else httpx.HTTPTransport()
+
+    def handle_request(self, request):
+        key = request_key(request)
+        if self.mode == "replay":
+            time.sleep(replay_delay())
+            return _replay_response(self.cassette, key, request)
+        response = self._inner.handle_request(request)
+        try:
+            body = response.read()
+        finally:
+            response.close()
+        return _record_response(self.cassette, key, request, response, body)
+
+    def close(self):
+        self._inner.close()
+
+
+class AsyncCassetteTransport(httpx.AsyncBaseTransport):
+    """Async counterpart of CassetteTransport"""
+
+    def __init__(self, mode, cassette=None, limits=None):
+        self.mode = mode
+        self.cassette = cassette or Cassette()
+        self._inner = httpx.AsyncHTTPTransport(limits=limits) if limits else httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request):
+        import asyncio
+        await request.aread()
+        key = request_key(request)
+        if self.mode == "replay":
+            await asyncio.sleep(replay_delay())
+            return _replay_response(self.cassette, key, request)
+        response = await self._inner.handle_async_request(request)
+        try:
+            body = await response.aread()
+        finally:
+            await response.aclose()
+        return _record_response(self.cassette, key, request, response, body)
+
+    async def aclose(self):
+        await self._inner.aclose()
+
+
+def http_transport(limits=None):
+    """Transport for a sync httpx client, or None to use the default in live mode"""
+    mode = backend_mode()
+    return None if mode == "live" else CassetteTransport(mode, limits=limits)
+
+
+def async_http_transport(limits=None):
+    mode = backend_mode()
+    return None if mode == "live" else AsyncCassetteTransport(mode, limits=limits)
+
+
+def elevenlabs_client(api_key):
+    """ElevenLabs client whose HTTP traffic goes through the active backend"""
+    from elevenlabs.client import ElevenLabs
+    transport = http_transport()
+    if transport is None:
+        return ElevenLabs(api_key=api_key)
+    return ElevenLabs(api_key=api_key or "replay", httpx_client=httpx.Client(transport=transport, timeout=240))
+
+
+def _tts_write_to_fp(original):
+    """Wrap gTTS.write_to_fp so speech is recorded to / replayed from cassettes"""
+    cassette = Cassette()
+
+    def write_to_fp(self, fp):
+        mode = backend_mode()
+        key = _fingerprint("gtts", self.text, self.lang, self.tld, str(self.speed))
+        if mode == "replay":
+            time.sleep(replay_delay())
+            if _inject_error():
+                from gtts.tts import gTTSError
+                raise gTTSError("Injected failure")
+            record = cassette.load("gtts", key)
+            if record is None:
+                # Response text differs from run to run: speak any recording, ideally in the same language
+                record = cassette.any("gtts", prefer=lambda record: record.get("lang") == self.lang)
+                if record is not None:
+                    _count("approximate")
+            if record is None:
+                _count("misses")
+                from gtts.tts import gTTSError
+                raise gTTSError(f"No cassette recorded for gTTS text '{self.text[:40]}'")
+            _count("replayed")
+            fp.write(base64.b64decode(record["audio"]))
+            return
+        buffer = io.BytesIO()
+        original(self, buffer)
+        audio = buffer.getvalue()
+        if mode == "record":
+            cassette.save("gtts", key, {
+                "text": self.text,
+                "lang": self.lang,
+                "audio": base64.b64encode(audio).decode("ascii"),
+            })
+            _count("recorded")
+        fp.write(audio)
+
+    write_to_fp.__wrapped__ = original
+    return write_to_fp
+
+
+def install():
+    """Route gTTS through the active backend (Groq and ElevenLabs use the transports above).
+
+    Safe to call more than once; does nothing in live mode.
+    """
+    global _installed
+    with _lock:
+        if _installed or backend_mode() == "live":
+            return
+        from gtts.tts import gTTS
+        gTTS.write_to_fp = _tts_write_to_fp(gTTS.write_to_fp)
+        _installed = True
+    logger.info(f"AI doctor backend: {backend_mode()} (cassettes in {AI_DOCTOR_CASSETTE_DIR})")
@@ -0,0 +1,79 @@
+# Request coalescing: concurrent callers with the same key share one in-flight call
+import concurrent.futures
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """Run at most one call per key at a time; everyone else waits for its result.
+
+    The first caller for a key (the leader) runs the function. Callers that
+    arrive while it is running get the same result, or the same exception,
+    instead of repeating the work. Threads and coroutines share one table,
+    so a sync and an async caller for the same key are coalesced too.
+    """
+
+    def __init__(self, name="single_flight"):
+        self.name = name
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._stats = {"calls": 0, "executed": 0, "shared": 0}
+
+    def _join(self, key):
+        """Return (future, is_leader) for key"""
+        with self._lock:
+            self._stats["calls"] += 1
+            future = self._inflight.get(key)
+            if future is not None:
+                self._stats["shared"] += 1
+                return future, False
+            future = concurrent.futures.Future()
+            self._inflight[key] = future
+            self._stats["executed"] += 1
+            return future, True
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            self._inflight.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, func, *args, **kwargs):
+        """Call func(*args, **kwargs) unless a call for key is already running"""
+        future, leader = self._join(key)
+        if not leader:
+            logger.debug(f"{self.name}: joined in-flight call")
+            return future.result()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    async def do_async(self, key, func, *args, **kwargs):
+        """Await func(*args, **kwargs) unless a call for key is already running"""
+        import asyncio
+        future, leader = self._join(key)
+        if not leader:
+            logger.debug(f"{self.name}: joined in-flight call")
+            return await asyncio.wrap_future(future)
+        try:
+            result = await func(*args, **kwargs)
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    def stats(self):
+        """How many calls were made, how many ran and how many were saved by sharing"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._inflight)
+        return stats
@@ -0,0 +1,106 @@
+# Sentence-chunked speech synthesis: chunks render in parallel and the first one can play before the rest are done
+import concurrent.futures
+import io
+import logging
+import os
+import re
+import threading
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# Sentences are merged into chunks of up to this many characters (gTTS fetches ~100 at a time anyway)
+TTS_CHUNK_CHARS = int(os.environ.get("TTS_CHUNK_CHARS", "200"))
+# Chunks synthesized at once across the whole process
+TTS_MAX_PARALLEL = int(os.environ.get("TTS_MAX_PARALLEL", "4"))
+
+# A sentence ends at . ! ? or the Devanagari danda, followed by whitespace; line breaks end one too.
+# Requiring the whitespace keeps "0.5 mg" and "e.g.," in one piece.
+_SENTENCE_END = re.compile(r"(?<=[.!?।॥])\s+|\s*\n+\s*")
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Shared thread pool that bounds concurrent synthesis"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=TTS_MAX_PARALLEL,
+                thread_name_prefix="tts",
+            )
+        return _executor
+
+
+def split_sentences(text, max_chars=TTS_CHUNK_CHARS):
+    """Split text into speakable chunks on sentence boundaries.
+
+    The first chunk is always a single sentence so it renders quickly;
+    later sentences are merged up to max_chars. A sentence longer than
+    max_chars stays whole rather than being cut mid-word.
+    """
+    sentences = [sentence.strip() for sentence in _SENTENCE_END.split(text or "")]
+    sentences = [sentence for sentence in sentences if sentence and re.search(r"\w", sentence)]
+    chunks = sentences[:1]
+    for sentence in sentences[1:]:
+        if len(chunks) > 1 and len(chunks[-1]) + 1 + len(sentence) <= max_chars:
+            chunks[-1] = f"{chunks[-1]} {sentence}"
+        else:
+            chunks.append(sentence)
+    return chunks
+
+
+@lru_cache(maxsize=256)
+def gtts_mp3(text, lang):
+    """MP3 bytes for one chunk; repeated sentences (headers, disclaimers) are rendered once"""
+    from gtts import gTTS
+    buffer = io.BytesIO()
+    gTTS(text=text, lang=lang).write_to_fp(buffer)
+    return buffer.getvalue()
+
+
+class ChunkedSpeech:
+    """Speech for text, synthesized chunk by chunk on the shared pool.
+
+    Construction submits every chunk and returns at once. first() waits
+    only for the opening sentence; result() joins all chunks in order
+    (MP3 streams can be concatenated frame for frame).
+    """
+
+    def __init__(self, text, lang, synthesize=gtts_mp3, executor=None):
+        self.chunks = split_sentences(text)
+        executor = executor or get_executor()
+        self._futures = [executor.submit(synthesize, chunk, lang) for chunk in self.chunks]
+
+    def first(self, timeout=None):
+        """Audio of the first chunk, or None if there is no text"""
+        return self._futures[0].result(timeout) if self._futures else None
+
+    def __iter__(self):
+        """Chunk audio in order, each as soon as it and everything before it are ready"""
+        for future in self._futures:
+            yield future.result()
+
+    def result(self, timeout=None):
+        """The whole text's audio"""
+        concurrent.futures.wait(self._futures, timeout)
+        return b"".join(future.result(0) for future in self._futures)
+
+    def cancel(self):
+        """Drop chunks that have not started yet"""
+        for future in self._futures:
+            future.cancel()
+
+
+def synthesize_speech(text, lang, on_first_chunk=None, synthesize=gtts_mp3):
+    """MP3 for text, rendered in parallel chunks; on_first_chunk(audio) is called as soon as the opening sentence is ready"""
+    speech = ChunkedSpeech(text, lang, synthesize)
+    try:
+        if on_first_chunk is not None and speech.chunks:
+            on_first_chunk(speech.first())
+        return speech.result()
+    except BaseException:
+        speech.cancel()
+        raise
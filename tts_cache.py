@@ -0,0 +1,197 @@
+# Content-addressed cache for synthesized speech, bounded by total size and evicting least recently used
+import atexit
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+VOICE_CACHE_DIR = os.environ.get("VOICE_CACHE_DIR", "voice_cache")
+VOICE_CACHE_MAX_BYTES = int(os.environ.get("VOICE_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+# Bump whenever the synthesis settings change so older recordings are not reused
+TTS_CACHE_VERSION = "1"
+
+MANIFEST = "manifest.json"
+# Access times from cache hits are written to the manifest at most this often
+MANIFEST_FLUSH_SECONDS = 30
+
+
+def speech_key(text, language, voice, engine="gtts"):
+    """Stable digest identifying one rendering of text (unlike hash(), the same in every process)"""
+    payload = json.dumps([TTS_CACHE_VERSION, engine, text, language, voice], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _atomic_write(path, data):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+
+
+class VoiceCache:
+    """Directory of audio files named by speech_key, with a manifest of sizes and access times.
+
+    Files are written to a temporary name and renamed into place, so a
+    reader in another worker never sees half a file. The manifest is read
+    once and then kept in memory: hits only update access times there, and
+    it is written back (also via a temporary file and rename) after writes
+    and at most every MANIFEST_FLUSH_SECONDS after hits. Before evicting or
+    writing it back, it is reconciled with the directory, so files written
+    by other workers are adopted and count towards max_bytes.
+    """
+
+    def __init__(self, directory=VOICE_CACHE_DIR, max_bytes=VOICE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = None
+        self._dirty = False
+        self._flushed_at = 0.0
+        self._stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+
+    def path(self, key, ext=".wav"):
+        return os.path.join(self.directory, key + ext)
+
+    def _manifest_path(self):
+        return os.path.join(self.directory, MANIFEST)
+
+    def _load(self):
+        """Manifest entries {file name: {"size", "accessed_at"}} reconciled with the directory"""
+        try:
+            with open(self._manifest_path(), encoding="utf-8") as f:
+                entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            entries = {}
+        try:
+            names = {name for name in os.listdir(self.directory) if name != MANIFEST and not name.endswith(".tmp")}
+        except FileNotFoundError:
+            return {}
+        entries = {name: entry for name, entry in entries.items() if name in names}
+        for name in names - entries.keys():
+            with contextlib.suppress(FileNotFoundError):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries[name] = {"size": stat.st_size, "accessed_at": stat.st_mtime}
+        return entries
+
+    def _memory(self):
+        """In-memory entries, loaded from disk on first use (call with the lock held)"""
+        if self._entries is None:
+            self._entries = self._load()
+        return self._entries
+
+    def _reconcile(self):
+        """Merge the directory and other workers' manifest into memory, keeping the latest access times"""
+        entries = self._load()
+        for name, entry in (self._entries or {}).items():
+            if name in entries:
+                entries[name]["accessed_at"] = max(entries[name]["accessed_at"], entry["accessed_at"])
+        self._entries = entries
+
+    def _flush(self):
+        try:
+            # Merge first so the write neither drops other workers' entries nor keeps evicted ones
+            self._reconcile()
+            _atomic_write(self._manifest_path(), self._entries)
+            self._dirty = False
+            self._flushed_at = time.monotonic()
+        except OSError as e:
+            logger.warning(f"Voice cache manifest update failed: {str(e)}")
+
+    def flush(self):
+        """Write pending access times to the manifest"""
+        with self._lock:
+            if self._dirty:
+                self._flush()
+
+    def get(self, key, ext=".wav"):
+        """Path of the cached file for key, or None"""
+        path = self.path(key, ext)
+        name = os.path.basename(path)
+        with self._lock:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+            entries = self._memory()
+            entries.setdefault(name, {"size": size})["accessed_at"] = time.time()
+            self._dirty = True
+            if time.monotonic() - self._flushed_at >= MANIFEST_FLUSH_SECONDS:
+                self._flush()
+        return path
+
+    @contextlib.contextmanager
+    def writing(self, key, ext=".wav"):
+        """Yield a temporary path to write the audio to; it is renamed into the cache on success"""
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        try:
+            yield temp_path
+            path = self.path(key, ext)
+            os.replace(temp_path, path)
+        finally:
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+        name = os.path.basename(path)
+        with self._lock:
+            self._stats["writes"] += 1
+            try:
+                entries = self._memory()
+                entries[name] = {"size": os.path.getsize(path), "accessed_at": time.time()}
+                if sum(entry["size"] for entry in entries.values()) > self.max_bytes:
+                    # Count what other workers have written before deciding what to drop
+                    self._reconcile()
+                    self._evict(self._entries, keep=name)
+            except OSError as e:
+                logger.warning(f"Voice cache update failed: {str(e)}")
+            self._flush()
+
+    def _evict(self, entries, keep=None):
+        total = sum(entry["size"] for entry in entries.values())
+        for name in sorted(entries, key=lambda name: entries[name]["accessed_at"]):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(self.directory, name))
+            total -= entries.pop(name)["size"]
+            self._stats["evictions"] += 1
+
+    def stats(self):
+        """Hit/miss/eviction counters for this process plus the cache's current size"""
+        with self._lock:
+            stats = dict(self._stats)
+            entries = self._memory()
+            stats["entries"] = len(entries)
+            stats["bytes"] = sum(entry["size"] for entry in entries.values())
+        return stats
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def get_voice_cache():
+    """Process-wide voice cache, created on first use"""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = VoiceCache()
+            # Hits since the last flush would otherwise be lost on exit
+            atexit.register(_default_cache.flush)
+        return _default_cache
@@ -0,0 +1,167 @@
+# Short video intake: pick the sharpest, most distinct frames of a phone clip without decoding all of it
+import logging
+import os
+
+import av
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Frames handed on for analysis, and how many evenly spaced candidates they are chosen from
+VIDEO_MAX_FRAMES = int(os.environ.get("VIDEO_MAX_FRAMES", "3"))
+VIDEO_CANDIDATES = int(os.environ.get("VIDEO_CANDIDATES", "12"))
+# Mean absolute grey-level difference (0-255) between thumbnails for two frames to count as different views
+VIDEO_MIN_CHANGE = float(os.environ.get("VIDEO_MIN_CHANGE", "12"))
+# Candidates are scored at this width; only the chosen frames are converted at full size
+SCORE_WIDTH = 320
+THUMB_SIZE = 32
+# Largest side of a chosen frame (encode_image shrinks further)
+FRAME_MAX_SIZE = 1024
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".m4v", ".webm", ".mkv", ".avi", ".3gp")
+
+
+def sharpness(gray):
+    """Variance of the 4-neighbour Laplacian: high for crisp detail, low for motion blur or bad focus"""
+    g = gray.astype(np.float32)
+    lap = 4 * g[1:-1, 1:-1] - g[:-2, 1:-1] - g[2:, 1:-1] - g[1:-1, :-2] - g[1:-1, 2:]
+    return float(lap.var())
+
+
+def thumbnail(gray, size=THUMB_SIZE):
+    """Block-averaged size x size thumbnail for comparing frames"""
+    h, w = gray.shape
+    rows = np.linspace(0, h, size + 1).astype(int)
+    cols = np.linspace(0, w, size + 1).astype(int)
+    # Sum over blocks with cumulative sums so uneven block sizes are handled exactly
+    total = np.pad(gray.astype(np.float64).cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    sums = total[rows[1:]][:, cols[1:]] - total[rows[:-1]][:, cols[1:]] - total[rows[1:]][:, cols[:-1]] + total[rows[:-1]][:, cols[:-1]]
+    areas = np.outer(np.diff(rows), np.diff(cols))
+    return (sums / areas).astype(np.float32)
+
+
+def scene_change(thumb_a, thumb_b):
+    """Mean absolute difference of two thumbnails (0-255)"""
+    return float(np.abs(thumb_a - thumb_b).mean())
+
+
+def _duration(container, stream):
+    """Clip length in seconds, or None if the container does not say"""
+    if stream.duration and stream.time_base:
+        return float(stream.duration * stream.time_base)
+    if container.duration:
+        return container.duration / av.time_base
+    return None
+
+
+def _seek_candidates(container, stream, count, duration):
+    """One decoded keyframe at or before each of count evenly spaced timestamps"""
+    start = float(stream.start_time * stream.time_base) if stream.start_time and stream.time_base else 0.0
+    seen = set()
+    for i in range(count):
+        target = start + duration * (i + 0.5) / count
+        container.seek(int(target / stream.time_base), stream=stream, backward=True, any_frame=False)
+        for frame in container.decode(stream):
+            # Several targets can land on the same keyframe
+            if frame.pts not in seen:
+                seen.add(frame.pts)
+                yield frame
+            break
+
+
+def _keyframe_candidates(stream, container, count):
+    """Keyframes from the start of the clip, for containers that cannot seek or report a duration"""
+    stream.codec_context.skip_frame = "NONKEY"
+    try:
+        for i, frame in enumerate(container.decode(stream)):
+            if i >= count:
+                break
+            yield frame
+    finally:
+        stream.codec_context.skip_frame = "DEFAULT"
+
+
+def _score(frame):
+    height = max(2, round(frame.height * SCORE_WIDTH / frame.width / 2) * 2)
+    gray = frame.reformat(width=SCORE_WIDTH, height=height, format="gray").to_ndarray()
+    return sharpness(gray), thumbnail(gray)
+
+
+def _full_frame(frame):
+    scale = min(1.0, FRAME_MAX_SIZE / max(frame.width, frame.height))
+    width = max(2, round(frame.width * scale / 2) * 2)
+    height = max(2, round(frame.height * scale / 2) * 2)
+    return frame.reformat(width=width, height=height, format="rgb24").to_ndarray()
+
+
+def _scenes(scored, min_change):
+    """Split time-ordered (sharpness, thumbnail, frame) candidates into scenes at unusually large changes"""
+    changes = [scene_change(a[1], b[1]) for a, b in zip(scored, scored[1:])]
+    # Panning and refocusing change every frame a little; a cut changes it much more than usual
+    cut = max(min_change, 1.5 * float(np.median(changes))) if changes else min_change
+    scenes = [[scored[0]]] if scored else []
+    for candidate, change in zip(scored[1:], changes):
+        if change > cut:
+            scenes.append([])
+        scenes[-1].append(candidate)
+    return scenes
+
+
+def _choose(scored, max_frames, min_change):
+    """The sharpest frame of each scene, sharpest scenes first, then other distinct sharp frames"""
+    best = [max(scene, key=lambda item: item[0]) for scene in _scenes(scored, min_change)]
+    chosen = sorted(best, key=lambda item: item[0], reverse=True)[:max_frames]
+    for candidate in sorted(scored, key=lambda item: item[0], reverse=True):
+        if len(chosen) >= max_frames:
+            break
+        if all(candidate is not other and scene_change(candidate[1], other[1]) >= min_change for other in chosen):
+            chosen.append(candidate)
+    return chosen
+
+
+def select_keyframes(video, max_frames=VIDEO_MAX_FRAMES, candidates=VIDEO_CANDIDATES, min_change=VIDEO_MIN_CHANGE):
+    """The sharpest distinct frames of a short clip, in time order.
+
+    video is a path or a file-like object (e.g. a Streamlit upload). Only
+    about `candidates` keyframes are decoded: evenly spaced seeks when the
+    clip's duration is known, otherwise the first keyframes. The clip is
+    split into scenes where consecutive candidates change unusually much;
+    the sharpest frame of each scene is taken first, then other sharp
+    frames at least min_change away from those already taken. Returns a list of
+    {"time", "sharpness", "image"} with image as an RGB numpy array.
+    """
+    with av.open(video) as container:
+        if not container.streams.video:
+            raise ValueError("No video track found")
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        duration = _duration(container, stream)
+        if duration:
+            frames = _seek_candidates(container, stream, candidates, duration)
+        else:
+            frames = _keyframe_candidates(stream, container, candidates)
+
+        scored = []
+        for frame in frames:
+            score, thumb = _score(frame)
+            scored.append((score, thumb, frame))
+
+        chosen = _choose(scored, max_frames, min_change)
+
+        results = [{
+            "time": float(frame.pts * stream.time_base) if frame.pts is not None else None,
+            "sharpness": score,
+            "image": _full_frame(frame),
+        } for score, _, frame in chosen]
+    results.sort(key=lambda result: result["time"] or 0.0)
+    logger.info(f"Video intake: {len(results)} of {len(scored)} candidate frames kept")
+    return results
+
+
+def encode_video_frames(video, max_frames=VIDEO_MAX_FRAMES, max_size=256, max_bytes=None):
+    """Base64 JPEGs of the best frames of a clip, ready for analyze_images_with_query"""
+    from brain_of_the_doctor import encode_images
+    frames = select_keyframes(video, max_frames)
+    if not frames:
+        raise ValueError("No usable frames found in the video")
+    return encode_images([frame["image"] for frame in frames], max_size, max_bytes)
@@ -5,6 +5,8 @@ load_dotenv()
 #Step1a: Setup Text to Speech–TTS–model with gTTS
 import os
 from gtts import gTTS
+from replay_backend import install as install_backend
+install_backend()  # record/replay gTTS when AI_DOCTOR_BACKEND is set
 from pydub import AudioSegment
 
 def text_to_speech_with_gtts_old(input_text, output_filepath):
@@ -24,11 +26,12 @@ text_to_speech_with_gtts_old(input_text=input_text, output_filepath="gtts_testin
 #Step1b: Setup Text to Speech–TTS–model with ElevenLabs
 import elevenlabs
 from elevenlabs.client import ElevenLabs
+from replay_backend import elevenlabs_client
 
 ELEVENLABS_API_KEY=os.environ.get("ELEVENLABS_API_KEY")
 
 def text_to_speech_with_elevenlabs_old(input_text, output_filepath):
-    client=ElevenLabs(api_key=ELEVENLABS_API_KEY)
+    client=elevenlabs_client(ELEVENLABS_API_KEY)
     audio=client.generate(
         text= input_text,
         voice= "Aria",
@@ -51,15 +54,17 @@ def play_human_voice(input_text, output_filepath="final.wav", recursion_depth=0)
     if recursion_depth >= MAX_RECURSION:
         raise ValueError("Maximum recursion depth reached in voice generation")
         
-    # Create cache dir if needed
-    os.makedirs("voice_cache", exist_ok=True)
-    
     # Check if we have a cached version
-    cache_key = f"human_male-{hash(input_text)}"
-    cache_file = f"voice_cache/{cache_key}.wav"
-    
-    if os.path.exists(cache_file):
-        return cache_file
+    cache_key = speech_key(input_text, "English", "human_male", engine="samples")
+    cache_file = get_voice_cache().get(cache_key)
+    if cache_file:
+        try:
+            if cache_file != output_filepath:
+                shutil.copyfile(cache_file, output_filepath)
+            return output_filepath
+        except FileNotFoundError:
+            # Evicted between lookup and copy: convert the sample again
+            pass
     
     # Common phrases mapping to sample files
     common_phrases = {
@@ -76,9 +81,11 @@ def play_human_voice(input_text, output_filepath="final.wav", recursion_depth=0)
         if phrase in lower_text:
             try:
                 if os.path.exists(sample_file):
-                    # Copy the sample to output path
+                    # Keep the converted sample in the cache, then copy it to the output path
                     sound = AudioSegment.from_wav(sample_file)
-                    sound.export(output_filepath, format="wav")
+                    with get_voice_cache().writing(cache_key) as temp_path:
+                        sound.export(temp_path, format="wav")
+                    shutil.copyfile(get_voice_cache().path(cache_key), output_filepath)
                     return output_filepath
             except Exception as e:
                 print(f"Warning: Could not process voice sample {sample_file}: {str(e)}")
@@ -92,20 +99,69 @@ def play_human_voice(input_text, output_filepath="final.wav", recursion_depth=0)
         voice_pack="default"
     )
 
-from functools import lru_cache
-import os
+import shutil
+from single_flight import SingleFlight
+from tts_cache import get_voice_cache, speech_key
+from audio_format import format_for_path, negotiate, path_for_format
+from phrase_bank import synthesize_with_phrases
+
+# Formats each engine produces, native format first
+GTTS_FORMATS = ("mp3", "wav")
+ELEVENLABS_FORMATS = {"mp3": "mp3_22050_32", "opus": "opus_48000_32"}
+
+# Concurrent requests for the same speech share one synthesis
+_syntheses = SingleFlight("tts")
+
+def _synthesize_to_cache(input_text, lang_code, cache_key, audio_format="mp3"):
+    """Render input_text with gTTS into the voice cache unless another call already did"""
+    cache = get_voice_cache()
+    extension = f".{audio_format}"
+    cache_file = cache.get(cache_key, extension)
+    if cache_file:
+        return cache_file
 
-@lru_cache(maxsize=100)
-def text_to_speech_with_gtts(input_text, output_filepath="final.wav", language="English", voice_pack="default"):
+    if audio_format == "wav":
+        # Transcode the cached MP3 (rendering it first if needed): one decode, one export
+        mp3_file = _syntheses.do(f"{cache_key}.mp3", _synthesize_to_cache, input_text, lang_code, cache_key, "mp3")
+        sound = AudioSegment.from_file(mp3_file, format="mp3")
+        with cache.writing(cache_key, extension) as temp_wav:
+            sound.export(temp_wav, format="wav")
+        return cache.path(cache_key, extension)
+
+    # gTTS already speaks MP3: it goes into the cache as is, without decoding. Fixed phrases
+    # (disclaimers, prescription headings) come pre-rendered from the phrase bank
+    mp3 = synthesize_with_phrases(input_text, lang_code)
+    with cache.writing(cache_key, extension) as temp_mp3:
+        with open(temp_mp3, "wb") as f:
+            f.write(mp3)
+    return cache.path(cache_key, extension)
+
+def text_to_speech_with_gtts(input_text, output_filepath="final.wav", language="English", voice_pack="default",
+                             output_format=None):
+    """Speak input_text into output_filepath and return the cached file.
+
+    output_format ("mp3" or "wav") defaults to the output file's extension.
+    MP3 is gTTS's native format and is stored untouched; WAV costs a decode
+    and is about ten times larger, so only ask for it if the player needs it.
+    """
     # First check if human voice requested
     if voice_pack == "human_male":
         return play_human_voice(input_text, output_filepath)
-        
-    # Check cache first
-    cache_key = f"{hash(input_text)}-{language}-{voice_pack}"
-    cache_file = f"voice_cache/{cache_key}.wav"
-    if os.path.exists(cache_file):
-        return cache_file
+
+    audio_format = negotiate(output_format or format_for_path(output_filepath), GTTS_FORMATS)
+    output_filepath = path_for_format(output_filepath, audio_format)
+
+    # Check cache first (keys are digests, so they survive restarts and are shared by workers)
+    cache_key = speech_key(input_text, language, voice_pack)
+    cache_file = get_voice_cache().get(cache_key, f".{audio_format}")
+    if cache_file:
+        try:
+            if cache_file != output_filepath:
+                shutil.copyfile(cache_file, output_filepath)
+            return cache_file
+        except FileNotFoundError:
+            # Evicted between lookup and copy: synthesize it again below
+            pass
         
     supported_languages = {
         'English': {'code': 'en', 'voices': ['default', 'uk', 'us', 'au', 'human_male']},
@@ -124,26 +180,12 @@ def text_to_speech_with_gtts(input_text, output_filepath="final.wav", language="
     elif voice_pack == "au":
         lang_code = "en-au"
     
-    # Create cache dir if needed
-    os.makedirs("voice_cache", exist_ok=True)
-    
-    # First save as temporary MP3
-    temp_file = "temp.mp3"
-    audioobj = gTTS(
-        text=input_text,
-        lang=lang_code,
-        slow=False
-    )
-    audioobj.save(temp_file)
-    
-    # Convert to WAV format
-    sound = AudioSegment.from_mp3(temp_file)
-    sound.export(cache_file, format="wav")
-    os.remove(temp_file)
+    cache_file = _syntheses.do(f"{cache_key}.{audio_format}", _synthesize_to_cache, input_text, lang_code, cache_key,
+                               audio_format)
     
     # Copy to requested output path if different
     if cache_file != output_filepath:
-        sound.export(output_filepath, format="wav")
+        shutil.copyfile(cache_file, output_filepath)
     
     return cache_file  # Return cached file path
 
@@ -151,8 +193,18 @@ def text_to_speech_with_gtts(input_text, output_filepath="final.wav", language="
 input_text="Hi this is Ai with Hassan, autoplay testing!"
 #text_to_speech_with_gtts(input_text=input_text, output_filepath="gtts_testing_autoplay.mp3")
 
+def tts_coalescing_stats():
+    """Counters for speech requests that shared an in-flight synthesis"""
+    return _syntheses.stats()
+
+
+def text_to_speech_with_elevenlabs(input_text, output_filepath, voice="Aria", output_format=None):
+    """Speak input_text with ElevenLabs and return the path written.
 
-def text_to_speech_with_elevenlabs(input_text, output_filepath, voice="Aria"):
+    ElevenLabs produces MP3 or Opus; any other requested format (including
+    one implied by output_filepath's extension) gets MP3, written next to
+    output_filepath with a .mp3 extension.
+    """
     if voice == "human_male":
         return play_human_voice(input_text, output_filepath)
     if not ELEVENLABS_API_KEY:
@@ -160,7 +212,7 @@ def text_to_speech_with_elevenlabs(input_text, output_filepath, voice="Aria"):
         return text_to_speech_with_gtts(input_text, output_filepath)
         
     try:
-        client=ElevenLabs(api_key=ELEVENLABS_API_KEY)
+        client=elevenlabs_client(ELEVENLABS_API_KEY)
         
         voice_packs = {
             'professional': 'Aria',
@@ -171,10 +223,12 @@ def text_to_speech_with_elevenlabs(input_text, output_filepath, voice="Aria"):
         
         selected_voice = voice_packs.get(voice, 'Aria')
         
+        audio_format = negotiate(output_format or format_for_path(output_filepath), tuple(ELEVENLABS_FORMATS))
+        output_filepath = path_for_format(output_filepath, audio_format)
         audio=client.generate(
             text=input_text,
             voice=selected_voice,
-            output_format="mp3_22050_32",
+            output_format=ELEVENLABS_FORMATS[audio_format],
             model="eleven_turbo_v2"
         )
         elevenlabs.save(audio, output_filepath)
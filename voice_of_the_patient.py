@@ -1,10 +1,12 @@
 # Simplified voice module for Streamlit deployment
+import asyncio
 import logging
 import os
-from groq import Groq
 import tempfile
 from datetime import datetime
 from dotenv import load_dotenv
+from groq_client import get_client, get_async_client, resolve_api_key
+from rate_limiter import groq_call, groq_call_async
 
 # Load environment variables
 load_dotenv()
@@ -13,28 +15,21 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def get_api_key():
-    """Get API key from Streamlit secrets or environment variables"""
-    try:
-        import streamlit as st
-        return st.secrets["GROQ_API_KEY"]
-    except (ImportError, KeyError, AttributeError):
-        return os.getenv("GROQ_API_KEY")
-
 def transcribe_with_groq(stt_model, audio_filepath, GROQ_API_KEY=None):
     """
     Transcribe audio using Groq API with Whisper model
     """
     logger.info(f"Attempting to transcribe {audio_filepath} with model {stt_model}")
     try:
-        api_key = GROQ_API_KEY or get_api_key()
+        api_key = GROQ_API_KEY or resolve_api_key()
         if not api_key:
             raise ValueError("Groq API key not found.")
 
-        client = Groq(api_key=api_key)
+        client = get_client(api_key)
         
         with open(audio_filepath, "rb") as file:
-            transcription = client.audio.transcriptions.create(
+            transcription = groq_call(
+                client.audio.transcriptions.create,
                 file=(os.path.basename(audio_filepath), file.read()),
                 model=stt_model,
             )
@@ -43,15 +38,49 @@ def transcribe_with_groq(stt_model, audio_filepath, GROQ_API_KEY=None):
         return transcription.text
 
     except Exception as e:
-        logger.error(f"Error transcribing with Groq: {str(e)}")
-        if "401" in str(e) or "invalid_api_key" in str(e).lower():
-            logger.error("The provided Groq API key is invalid or expired.")
-        elif "403" in str(e):
-            logger.error("Insufficient permissions or quota on Groq.")
-        elif "429" in str(e):
-            logger.error("Rate limit exceeded for Groq API.")
+        _log_transcription_error(e)
         return None
 
+async def transcribe_with_groq_async(stt_model, audio_filepath, GROQ_API_KEY=None):
+    """
+    Async version of transcribe_with_groq using the shared async client
+    """
+    logger.info(f"Attempting to transcribe {audio_filepath} with model {stt_model}")
+    try:
+        api_key = GROQ_API_KEY or resolve_api_key()
+        if not api_key:
+            raise ValueError("Groq API key not found.")
+
+        client = get_async_client(api_key)
+
+        # Read the file off the event loop
+        audio_bytes = await asyncio.to_thread(_read_file, audio_filepath)
+        transcription = await groq_call_async(
+            client.audio.transcriptions.create,
+            file=(os.path.basename(audio_filepath), audio_bytes),
+            model=stt_model,
+        )
+
+        logger.info("Transcription successful.")
+        return transcription.text
+
+    except Exception as e:
+        _log_transcription_error(e)
+        return None
+
+def _read_file(file_path):
+    with open(file_path, "rb") as file:
+        return file.read()
+
+def _log_transcription_error(e):
+    logger.error(f"Error transcribing with Groq: {str(e)}")
+    if "401" in str(e) or "invalid_api_key" in str(e).lower():
+        logger.error("The provided Groq API key is invalid or expired.")
+    elif "403" in str(e):
+        logger.error("Insufficient permissions or quota on Groq.")
+    elif "429" in str(e):
+        logger.error("Rate limit exceeded for Groq API.")
+
 def record_audio(file_path):
     """
     Placeholder for audio recording - simplified for Streamlit